@@ -0,0 +1,76 @@
+"""broadcast.py - fan-out of the same update to many sessions
+
+Usage: python3 broadcast.py [--sessions N] [--rounds N]
+
+Compares updating the active page of N sessions one by one with
+session.page().update() against Group.update(), which formats the
+update once for all sessions. Measures queueing and flushing the
+browser queues. No network connections are involved.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import httpgui
+
+html_room = """
+<table>
+<tr><td>Server:</td><td id="time"></td></tr>
+<tr><td>Users:</td><td id="users"></td></tr>
+</table>
+"""
+
+def flush(sessions):
+    for session in sessions:
+        session._response_from_browser_queue()
+
+def main():
+    sessions_count, rounds = 10000, 10
+    args = sys.argv[1:]
+    while args:
+        opt, value = args.pop(0), args.pop(0)
+        if opt == "--sessions":
+            sessions_count = int(value)
+        elif opt == "--rounds":
+            rounds = int(value)
+        else:
+            sys.exit(__doc__)
+    protocol = httpgui.Protocol()
+    group = protocol.group("room")
+    sessions = []
+    for _ in range(sessions_count):
+        session = httpgui.Session(protocol)
+        session.new_page(html_room)
+        sessions.append(session)
+        group.add(session)
+    flush(sessions)
+    users = ", ".join("user%d" % (i,) for i in range(50))
+
+    results = {}
+    for name in ("Page.update loop", "Group.update"):
+        t_update = t_flush = 0.0
+        for r in range(rounds):
+            update = {"users": users, "time": time.strftime(" %H:%M:%S") + str(r)}
+            t0 = time.perf_counter()
+            if name == "Group.update":
+                group.update(update)
+            else:
+                for session in sessions:
+                    session.page().update(update)
+            t1 = time.perf_counter()
+            flush(sessions)
+            t2 = time.perf_counter()
+            t_update += t1 - t0
+            t_flush += t2 - t1
+        results[name] = (t_update / rounds, t_flush / rounds)
+
+    print("sessions: %d, rounds: %d" % (sessions_count, rounds))
+    for name, (t_update, t_flush) in results.items():
+        print("%-18s update %7.2f ms  flush %7.2f ms  (%.2f us per session)" % (
+            name, t_update * 1000, t_flush * 1000,
+            (t_update + t_flush) / sessions_count * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""idle_sessions.py - memory and push latency with many idle sessions
+
+Usage: python3 idle_sessions.py [--engine threads|selectors] [--sessions N]
+                                [--pushes N] [--port PORT]
+
+Opens N browser-like sessions that all keep a wait_server_event
+request pending, then measures server memory (RSS), the number of
+server threads, and the latency of pushing Page.update()s to randomly
+chosen sessions. Clients run in a forked process so that their
+sockets do not count in the server's memory usage.
+"""
+
+import os
+import random
+import re
+import resource
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import httpgui
+
+def proc_status(field):
+    for line in open("/proc/self/status"):
+        if line.startswith(field + ":"):
+            return int(line.split()[1])
+    return -1
+
+def http_request(sock, path):
+    sock.sendall(b"GET %s HTTP/1.1\r\nHost: bench\r\n\r\n" % (path,))
+
+def http_response(sock):
+    data = b""
+    while not b"\r\n\r\n" in data:
+        data += sock.recv(65536)
+    head, body = data.split(b"\r\n\r\n", 1)
+    length = int(re.search(rb"Content-Length: ([0-9]+)", head).group(1))
+    while len(body) < length:
+        body += sock.recv(65536)
+    return head.split(b" ", 2)[1], body
+
+def clients(port, sessions, ready_w, results_w):
+    socks = {}
+    for i in range(sessions):
+        while 1:
+            s = socket.create_connection(("localhost", port))
+            http_request(s, b"/bench")
+            status, body = http_response(s)
+            if status == b"200":
+                break
+            s.close() # the app was not quick enough calling new_session
+            time.sleep(0.001)
+        session_id = re.search(rb'"session_id": "([^"]*)"', body).group(1)
+        server_event = 0
+        if not b'"initial": ' in body:
+            # the first page was not ready in time to be inlined
+            http_request(s, b"/%s/wait_server_event(0)" % (session_id,))
+            http_response(s) # first page
+            server_event = 1
+        http_request(s, b"/%s/wait_server_event(%d)" % (session_id, server_event))
+        socks[s] = [session_id, server_event + 1, b""]
+    os.write(ready_w, b"ready\n")
+    sel = selectors.DefaultSelector()
+    for s in socks:
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+    latencies = []
+    while 1:
+        for key, _ in sel.select():
+            s = key.fileobj
+            state = socks[s]
+            state[2] += s.recv(65536)
+            m = re.search(rb'"innerHTML","([0-9.]+)"', state[2])
+            if not m:
+                continue
+            if m.group(1) == b"0":
+                os.write(results_w, (" ".join("%.6f" % l for l in latencies) + "\n").encode())
+                os._exit(0)
+            latencies.append(time.monotonic() - float(m.group(1)))
+            state[2] = b""
+            http_request(s, b"/%s/wait_server_event(%d)" % (state[0], state[1]))
+            state[1] += 1
+
+def main():
+    engine, sessions, pushes, port = "selectors", 10000, 1000, 54321
+    args = sys.argv[1:]
+    while args:
+        opt, value = args.pop(0), args.pop(0)
+        if opt == "--engine":
+            engine = value
+        elif opt == "--sessions":
+            sessions = int(value)
+        elif opt == "--pushes":
+            pushes = int(value)
+        elif opt == "--port":
+            port = int(value)
+        else:
+            sys.exit(__doc__)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < sessions + 100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, sessions + 100), hard))
+    if engine == "threads":
+        threading.stack_size(256 * 1024)
+
+    ready_r, ready_w = os.pipe()
+    results_r, results_w = os.pipe()
+    rss_before = proc_status("VmRSS")
+    protocol = httpgui.Protocol(engine=engine)
+    app_sessions = []
+    def app():
+        while 1:
+            session = protocol.new_session("localhost:%d" % (port,))
+            session.new_page('<p id="t"></p>')
+            app_sessions.append(session)
+    threading.Thread(target=app, daemon=True).start()
+    time.sleep(0.2)
+    t0 = time.monotonic()
+    if os.fork() == 0:
+        clients(port, sessions, ready_w, results_w)
+    os.read(ready_r, 16)
+    setup_time = time.monotonic() - t0
+    time.sleep(1) # let last wait_server_events arrive
+    rss = proc_status("VmRSS")
+    threads = proc_status("Threads")
+    for session in random.sample(app_sessions, min(pushes, len(app_sessions))):
+        session.page().update({"t": "%f" % (time.monotonic(),)})
+        time.sleep(0.001)
+    time.sleep(0.5)
+    app_sessions[0].page().update({"t": "0"}) # stop the clients
+    latencies = sorted(float(l) for l in os.fdopen(results_r).readline().split())
+    os.wait()
+    print("engine:            %s" % (engine,))
+    print("idle sessions:     %d (established in %.1f s)" % (len(app_sessions), setup_time))
+    print("server threads:    %d" % (threads,))
+    print("server RSS:        %.1f MB (%.1f kB per session)" % (
+        rss / 1024, (rss - rss_before) / len(app_sessions)))
+    if latencies:
+        print("push latency p50:  %.2f ms" % (latencies[len(latencies) // 2] * 1000,))
+        print("push latency p99:  %.2f ms" % (latencies[int(len(latencies) * 0.99)] * 1000,))
+
+if __name__ == "__main__":
+    main()
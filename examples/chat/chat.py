@@ -8,6 +8,7 @@ Go to ROOM as USER by entering URL http://hostname/ROOM/USER
 """
 
 import html
+import itertools
 import sys
 import _thread
 import time
@@ -18,8 +19,16 @@ httpgui.log = lambda msg: sys.stderr.write(msg + "\n")
 
 html_chat_room = """
 <style>
-.t{font: 14px sans-serif; fill: black;}
-.e{font: bold 14px sans-serif; fill: blue;}
+.t{font: 14px sans-serif; color: black;}
+.e{font: bold 14px sans-serif; color: blue;}
+#messages{display: flex; flex-direction: column; justify-content: flex-end;
+          width: 480px; height: %(messages_height)dpx; overflow: hidden;}
+#messages div{flex: none; height: %(message_height)dpx; white-space: nowrap;}
+.new{animation: scroll-in 1s;}
+.shake{animation: shake 0.7s;}
+@keyframes scroll-in{from{transform: translateY(%(message_height)dpx);} to{transform: none;}}
+@keyframes shake{0%%{transform: translateX(2px);} 25%%{transform: translateX(4px);}
+                 50%%{transform: translateX(1px);} 100%%{transform: none;}}
 </style>
 <table>
 <tr><td>Server:</td><td id="time"></td></tr>
@@ -48,6 +57,7 @@ class Room_user:
 
 max_messages = 16
 message_height = 15
+message_ids = itertools.count() # a message has the same id for all users
 room_user = {} # {room: {user: Room_user}}
 
 def error(msg):
@@ -85,33 +95,36 @@ def onkeydown(ctx):
     elif ctx.event["key"] == "ArrowDown":
         onclick_down(ctx)
 
-def update_editing_message(room, user):
+def update_editing_message(room, user, editing_message):
     u = room_user[room][user]
+    updates = {}
     if not u.editing_message is None:
-        msg = u.messages[u.editing_message].split(": ", 1)[-1]
-        u.session.page().update({'message.value': html.unescape(msg)})
+        updates['msg-%d.className' % (u.messages[u.editing_message][0],)] = 't'
+    u.editing_message = editing_message
+    if not u.editing_message is None:
+        msg_id, msg = u.messages[u.editing_message]
+        updates['msg-%d.className' % (msg_id,)] = 'e'
+        updates['message.value'] = html.unescape(msg.split(": ", 1)[-1])
     else:
-        u.session.page().update({'message.value': ''})
-    update_messages(room, user, None)
+        updates['message.value'] = ''
+    u.session.page().update(updates)
 
 def onclick_up(ctx):
     room, user = ctx.session.room, ctx.session.user
     u = room_user[room][user]
     if u.editing_message is None:
-        u.editing_message = 0
-    else:
-        if u.editing_message + 1 < len(u.messages):
-            u.editing_message += 1
-    update_editing_message(room, user)
+        update_editing_message(room, user, 0)
+    elif u.editing_message + 1 < len(u.messages):
+        update_editing_message(room, user, u.editing_message + 1)
 
 def onclick_down(ctx):
     room, user = ctx.session.room, ctx.session.user
     u = room_user[room][user]
     if not u.editing_message is None:
-        u.editing_message -= 1
-        if u.editing_message < 0:
-            u.editing_message = None
-        update_editing_message(room, user)
+        if u.editing_message > 0:
+            update_editing_message(room, user, u.editing_message - 1)
+        else:
+            update_editing_message(room, user, None)
 
 def onclick_send(ctx):
     ctx.page.current(['message.value'],
@@ -122,32 +135,29 @@ def onclick_destroy(ctx):
     for user in room_user[room]:
         room_user[room][user].session.new_page(html_room_destroyed, static=True)
     del room_user[room]
+    httpgui.remove_group(room)
 
-def messages_to_html(room, user, animate):
-    u = room_user[room][user]
-    html = ['''
-    <svg height="%d" width="480">
-    ''' % (max_messages * message_height,)]
-    for m_index, m in enumerate(room_user[room][user].messages):
-        end_y = (max_messages - m_index - 1) * message_height
-        start_y = end_y
-        if m_index != u.editing_message:
-            text_class = "t"
-        else:
-            text_class = "e"
-        if animate == "scroll 1 up":
-            start_y = (max_messages - m_index) * message_height
-            animation = '<animate attributeName="y" from="%d" to="%d" dur="1s" fill="freeze"/>' % (start_y, end_y)
-        elif isinstance(animate, str) and animate.startswith("shake") and m_index == int(animate.split()[1]):
-            animation = '<animate attributeName="x" values="2;0;4;1;2;0;1;0" dur="0.7s"/>'
-        else:
-            animation = ""
-        html.append('<text x="0" y="%d" class="%s">%s%s</text>' % (start_y, text_class, animation, m))
-    html.append('</svg>')
-    return "\n".join(html)
+def message_to_html(msg_id, msg, text_class):
+    return '<div id="msg-%d" class="%s">%s</div>' % (msg_id, text_class, msg)
 
-def update_messages(room, user, animate):
-    room_user[room][user].session.page().update({'messages': messages_to_html(room, user, animate)})
+def messages_to_html(room, user):
+    # u.messages are newest first, the newest is shown at the bottom
+    return "\n".join([message_to_html(msg_id, msg, "t")
+                      for msg_id, msg in reversed(room_user[room][user].messages)])
+
+def add_message(room, user, msg_id, msg):
+    """show a new message at the bottom, drop the oldest message
+    that does not fit. Other messages are not sent again."""
+    u = room_user[room][user]
+    page = u.session.page()
+    u.messages.insert(0, (msg_id, msg))
+    page.append('messages', message_to_html(msg_id, msg, "t new"))
+    if not u.editing_message is None:
+        u.editing_message += 1 # keep editing the same message
+    if len(u.messages) > max_messages:
+        if u.editing_message == max_messages:
+            u.editing_message = None
+        page.remove('msg-%d' % (u.messages.pop()[0],))
 
 def send_message(session, message):
     message = html.escape(message)
@@ -155,20 +165,24 @@ def send_message(session, message):
     u = room_user[room][sender]
     if not u.editing_message is None:
         # modify existing message
-        orig_message = u.messages[u.editing_message]
+        edit_id = u.messages[u.editing_message][0]
+        u.editing_message = None
         for user in room_user[room]:
-            try:
-                edit_index = room_user[room][user].messages.index(orig_message)
-            except ValueError:
+            ru = room_user[room][user]
+            for m_index, (msg_id, msg) in enumerate(ru.messages):
+                if msg_id == edit_id:
+                    break
+            else:
                 continue # this user never received edited message
-            room_user[room][user].messages[edit_index] = sender + ": " + message
-            u.editing_message = None
-            update_messages(room, user, "shake " + str(edit_index))
+            ru.messages[m_index] = (msg_id, sender + ": " + message)
+            text_class = "e" if m_index == ru.editing_message else "t"
+            ru.session.page().replace('msg-%d' % (msg_id,),
+                                      message_to_html(msg_id, sender + ": " + message, text_class + " shake"))
     else:
         # add new message to all
+        msg_id = next(message_ids)
         for user in room_user[room]:
-            room_user[room][user].messages = ([sender + ": " + message] + room_user[room][user].messages)[:max_messages]
-            update_messages(room, user, "scroll 1 up")
+            add_message(room, user, msg_id, sender + ": " + message)
     session.page().update({'message.value': ''})
 
 def update_users(room):
@@ -179,10 +193,9 @@ def update_users(room):
         else:
             users.append(user)
     html_users = ", ".join(users)
-    for user in room_user[room]:
-        room_user[room][user].session.page().update(
-            {'users': html_users,
-             'time': time.strftime(" %H:%M:%S")})
+    httpgui.group(room).update(
+        {'users': html_users,
+         'time': time.strftime(" %H:%M:%S")})
 
 if __name__ == "__main__":
     try:
@@ -207,16 +220,20 @@ if __name__ == "__main__":
             room_user[room] = {}
         if user in room_user[room]:
             room_user[room][user].session.new_page(html_someone_replaced_you, static=True)
+            httpgui.group(room).remove(room_user[room][user].session)
             join_message = "entered room and replaced a user with the same name"
         else:
             join_message = "entered room"
         room_user[room][user] = Room_user() # todo: delete old?
         room_user[room][user].session = session
-        room_user[room][user].messages = ['entering ' + room + '...'] + ['' * (max_messages - 1)]
+        httpgui.group(room).add(session)
+        room_user[room][user].messages = [(next(message_ids), 'entering ' + room + '...')]
         session.new_page(html_chat_room %
                          {'room': room,
                           'user': user,
-                          'messages': messages_to_html(room, user, "scroll 1 up")},
+                          'messages': messages_to_html(room, user),
+                          'messages_height': max_messages * message_height,
+                          'message_height': message_height},
                          {'python-onkeydown(key)': "onkeydown(ctx)"})
 
         update_users(room)
@@ -31,31 +31,59 @@ while 1:
         '<p id="greeting" python-onclick="clicked(ctx)">(click me!)</p>')
 """
 
+import atexit
 import base64
+import collections
+import cProfile
+import email.utils
+import hashlib
+import heapq
 import json
+import mimetypes
+import os
+import pstats
 import re
+import selectors
+import shutil
 import socket
+import struct
+import sys
+import tempfile
 import _thread
 import time
 import traceback
 import types
 import urllib.parse
+import zlib
 
 class ProtocolError(Exception): pass
 
 _browser_side_js = """
-timer_interval_ms = %(timer_interval_ms)s; // milliseconds, zero disables timer
-pending_server_event = %(pending_server_event)s; // true or false, 1 or 0
+timer_interval_ms = 0; // milliseconds, zero disables timer
+pending_server_event = 1; // true or false, 1 or 0
 
 tick_count = 0;
 server_event_count = 0;
 
-session_id = "%(session)s";
+session_id = "";
+
+transport = "poll"; // "poll", "websocket" or "sse"
+websocket = null;
+websocket_open = false;
+event_stream = null;
+
+page_cache = {}; // {digest: html} of shown pages, the server evicts
 
 function send_to_server(url, content, callback) {
     if (session_id == "")
         return;
 
+    if (websocket_open && content != null && callback == eval_response) {
+        // responses arrive as websocket messages
+        websocket.send(url + "\\n" + content);
+        return;
+    }
+
     session_url = "/" + session_id + "/" + url;
 
     var xmlHttp = window.XMLHttpRequest ? new XMLHttpRequest() : new ActiveXObject("MSXML2.XMLHTTP.3.0");
@@ -72,7 +100,7 @@ function send_to_server(url, content, callback) {
 }
 
 function eval_response(xmlHttp) {
-    eval(xmlHttp.responseText);
+    apply_ops(xmlHttp.responseText);
 }
 
 function eval_time_response(xmlHttp) {
@@ -80,7 +108,7 @@ function eval_time_response(xmlHttp) {
         console.log("timer_tick: stopped at " + tick_count + ", last response status: " + xmlHttp.status);
         return;
     }
-    eval(xmlHttp.responseText);
+    apply_ops(xmlHttp.responseText);
     tick_count += 1;
     if (timer_interval_ms > 0)
         setTimeout(timer_tick, timer_interval_ms);
@@ -91,7 +119,7 @@ function event_received(xmlHttp) {
         console.log("wait_server_event: stopped at " + server_event_count + ", last response status: " + xmlHttp.status);
         return;
     }
-    eval(xmlHttp.responseText);
+    apply_ops(xmlHttp.responseText);
     wait_server_event();
 }
 
@@ -100,11 +128,186 @@ function wait_server_event() {
     server_event_count += 1;
 }
 
+function open_websocket() {
+    var ws_url = (location.protocol == "https:" ? "wss://" : "ws://") +
+        location.host + "/" + session_id + "/websocket";
+    try {
+        websocket = new WebSocket(ws_url);
+    } catch (err) {
+        wait_server_event();
+        return;
+    }
+    websocket.onopen = function() {
+        websocket_open = true;
+    }
+    websocket.onmessage = function(message) {
+        apply_ops(message.data);
+        if (session_id == "")
+            websocket.close();
+    }
+    websocket.onclose = function() {
+        websocket = null;
+        websocket_open = false;
+        // upgrade failed or connection lost, fall back to long-polling
+        if (session_id != "" && pending_server_event)
+            wait_server_event();
+    }
+}
+
+function open_event_stream() {
+    event_stream = new EventSource("/" + session_id + "/event_stream");
+    event_stream.onmessage = function(message) {
+        apply_ops(message.data);
+        if (session_id == "")
+            event_stream.close();
+    }
+    event_stream.onerror = function() {
+        // stream blocked or lost, fall back to long-polling
+        event_stream.close();
+        event_stream = null;
+        if (session_id != "" && pending_server_event)
+            wait_server_event();
+    }
+}
+
 function timer_tick() {
     if (timer_interval_ms > 0)
         send_to_server("timer_tick(ctx, " + tick_count + ")", "{}", eval_time_response);
 }
 
+function set_path(obj, path, value) {
+    // path is a property name or a dotted path like "style.color"
+    var names = path.split(".");
+    for (var i = 0; obj && i < names.length - 1; i++)
+        obj = obj[names[i]];
+    if (obj)
+        obj[names[names.length - 1]] = value;
+}
+
+function get_path(obj, path) {
+    var names = path.split(".");
+    for (var i = 0; obj && i < names.length; i++)
+        obj = obj[names[i]];
+    return obj;
+}
+
+function set_property(id, path, value) {
+    set_path(document.getElementById(id), path, value);
+}
+
+function set_attribute(id, attr, value) {
+    var elt = document.getElementById(id);
+    if (elt)
+        elt.setAttribute(attr, value);
+}
+
+function show_page(digest, html, evicted) {
+    // without html the page is shown from page_cache
+    for (var i = 0; evicted && i < evicted.length; i++)
+        delete page_cache[evicted[i]];
+    if (html === undefined) {
+        html = page_cache[digest];
+        if (html === undefined) {
+            // lost from the cache, load the session page again
+            location.replace("/" + session_id + "/");
+            return;
+        }
+    }
+    page_cache[digest] = html;
+    document.getElementById('rootdiv').innerHTML = html;
+}
+
+function cache_page(digest) {
+    page_cache[digest] = document.getElementById('rootdiv').innerHTML;
+}
+
+function apply_settings(settings) {
+    for (var name in settings)
+        window[name] = settings[name];
+    if (settings.timer_interval_ms > 0)
+        setTimeout(timer_tick, timer_interval_ms);
+}
+
+function send_current(token, names) {
+    // names are element ids (innerHTML) or id.property paths
+    var current = {};
+    for (var i = 0; i < names.length; i++) {
+        var dot = names[i].indexOf(".");
+        if (dot < 0)
+            current[names[i]] = get_path(document.getElementById(names[i]), "innerHTML");
+        else
+            current[names[i]] = get_path(document.getElementById(names[i].substring(0, dot)),
+                                         names[i].substring(dot + 1));
+    }
+    send_to_server(token, JSON.stringify({"current_dict": current}), eval_response);
+}
+
+function listen_window(js_event, token, event_attr_list) {
+    if (typeof(httpgui_events) == "undefined")
+        httpgui_events = Object();
+    if (typeof(httpgui_events[js_event]) == "undefined")
+        httpgui_events[js_event] = function (event) {
+            send_event(token, event, undefined, event_attr_list); };
+    window.removeEventListener(js_event, httpgui_events[js_event]);
+    window.addEventListener(js_event, httpgui_events[js_event]);
+}
+
+function insert_html(id, position, html) {
+    var elt = document.getElementById(id);
+    if (elt)
+        elt.insertAdjacentHTML(position, html);
+}
+
+function remove_element(id) {
+    var elt = document.getElementById(id);
+    if (elt)
+        elt.parentNode.removeChild(elt);
+}
+
+function replace_element(id, html) {
+    var elt = document.getElementById(id);
+    if (elt) {
+        elt.insertAdjacentHTML("afterend", html);
+        elt.parentNode.removeChild(elt);
+    }
+}
+
+function move_element(id, target_id, position) {
+    var elt = document.getElementById(id);
+    var target = document.getElementById(target_id);
+    if (elt && target)
+        target.insertAdjacentElement(position, elt);
+}
+
+function apply_ops(text) {
+    // text is a JSON array of [op, args...] operations from the
+    // browser queue, see _browser_op()
+    if (!text)
+        return;
+    var ops = JSON.parse(text);
+    for (var i = 0; i < ops.length; i++) {
+        var op = ops[i];
+        switch (op[0]) {
+        case "set": set_property(op[1], op[2], op[3]); break;
+        case "attr": set_attribute(op[1], op[2], op[3]); break;
+        case "window": set_path(window, op[1], op[2]); break;
+        case "page": document.getElementById('rootdiv').innerHTML = op[1]; break;
+        case "show": show_page(op[1], op[2], op[3]); break;
+        case "cache": cache_page(op[1]); break;
+        case "uncache": page_cache = {}; break;
+        case "settings": apply_settings(op[1]); break;
+        case "current": send_current(op[1], op[2]); break;
+        case "listen": listen_window(op[1], op[2], op[3]); break;
+        case "insert": insert_html(op[1], op[2], op[3]); break;
+        case "remove": remove_element(op[1]); break;
+        case "replace": replace_element(op[1], op[2]); break;
+        case "move": move_element(op[1], op[2], op[3]); break;
+        case "js": eval(op[1]); break;
+        default: console.log("unknown operation " + op[0]);
+        }
+    }
+}
+
 function properties_to_dict(obj, attr_list=undefined) {
     var dict = {};
     for (var property in obj) {
@@ -150,26 +353,61 @@ window.onkeydown = function(e) {
     e.preventDefault();
 }
 
-setTimeout(timer_tick, 1);
-if (pending_server_event) {
-    wait_server_event();
+// options: session_id, timer_interval_ms, pending_server_event,
+// transport and initial, the first response inlined in the page
+function httpgui_start(options) {
+    session_id = options.session_id;
+    timer_interval_ms = options.timer_interval_ms;
+    pending_server_event = options.pending_server_event;
+    transport = options.transport;
+    if (timer_interval_ms > 0)
+        setTimeout(timer_tick, 1);
+    if (options.initial)
+        apply_ops(options.initial);
+    if (pending_server_event) {
+        if (transport == "websocket" && window.WebSocket)
+            open_websocket();
+        else if (transport == "sse" && window.EventSource)
+            open_event_stream();
+        else
+            wait_server_event();
+    }
 }
 """
 
-_html_basepage='''
-<html><body>
-<div id="rootdiv">
-%s
-</div>
-<script language="JavaScript" type="text/javascript">
-%s
-</script>
+# The runtime is the same for all sessions. Browsers cache it, a
+# new version gets a new path.
+_browser_side_js_bytes = bytes(_browser_side_js, "utf-8")
+_browser_side_js_path = "/.httpgui/runtime-%s.js" % (hashlib.sha1(_browser_side_js_bytes).hexdigest()[:16],)
+_browser_side_js_resource = {
+    "Content-Type": "application/javascript; charset=utf-8",
+    "Cache-Control": "public, max-age=31536000, immutable",
+    "data": _browser_side_js_bytes}
+
+# Session options (JSON) and the first page, if it was ready in time,
+# are the only per-session parts of the page
+_html_basepage = (b'''<html><body>
+<div id="rootdiv">%b</div>
+<script src="''' + bytes(_browser_side_js_path, "utf-8") + b'''"></script>
+<script>httpgui_start(%b);</script>
 </body></html>
-'''
+''')
 
 default_favicon = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAD8AAABACAYAAACtK6/LAAAABGdBTUEAALGPC/xhBQAAACBjSFJNAAB6JgAAgIQAAPoAAACA6AAAdTAAAOpgAAA6mAAAF3CculE8AAAABmJLR0QA/wD/AP+gvaeTAAAACXBIWXMAAA7EAAAOxAGVKw4bAAAAB3RJTUUH4wgSES0yY33VcQAADmdJREFUaN7Vm3tQ1FeWxz/9BgQCBSJtbHAQjaaWaFFaiUJiNOpqYmKMOBLydJ2YVDKV7OpWxUxm8zYz7iZxkqxY5VapldUqgxGT4IskEsoHMZISMLx84AMERURQsOlumj77x4/u4dGPX2Obcb9V949f/W6fe77nnt+95557GkIHIzAF+CtQC7gACVG7CGwC5gJRIdT5pmECpgP/AzQAPSEk3be5gKvALmAJEPOPJK1DmemNQOstIuyrdQHfAwuA8N+aeALwHygz/VuSHtjae43/T78FaQ2QAfwAdP+DifdttcDTQNitIm4ClgHnbwOy3tp14D+B+FATjwTeBq7dBiT9NSfwJZAcKuIxwN8A+21ATm0rBO66WeJRwKeA4zYgFGz7HkgdKvEwYPX/sxkf2L4BRgZLXAu8AnTeBgRuprlQgq+gosI5QNNtoHwomg34994J7QeNF+JJKCvmfcG6C4BerycpKYn09HTuuusu4uLiEBGam5uprKzk119/pbGxEZfLNRTxPqHRaDAYDGg0GpxOJz09PX1fX0KJA/b303WADAPwb8C9wQ6u0+lIT09n6dKlzJkzh6SkJAwGQ78+NpuNs2fPsnfvXrZu3UpFRcVAJYPG8OHDeeCBB5g+fTpjx44lLCyMixcvcvDgQfbu3cv58+cRkUTgz0Al0OxL1lyGEKfHxMTIqlWr5MKFC6IW9fX18tZbb0lCQsKQ3DkiIkKefPJJOXjwoHR1dQ2S73Q6pby8XJYsWSJ6vd4dA7yBd28nBtgTrBKJiYmyefNmcTgcqon3VXDPnj0yceLEoMY0m82Sm5srHR0dAcdobW2Vl156SXQ6nQB1wD3eyD+NclpSrURCQoJ8+eWX4nK5gibeF8eOHZNp06apGjM1NVV27dolPT09quU3NzfL/Pnz3TL+hnIi9SAW5bASlNt9/vnnQSnhDxUVFTJ58mS/Y44ZM0a+++67IckvKSmRO++8U4B6YGJf8o8R5J6+bNkyuXHjRkiIu3HgwAFJSUnx6WU7duwYsuyenh5ZsWKFW977buJG4ItgiN99991SW1sbUuJubNy4USIjI/uNZzKZ5KOPPrppLystLZURI0YIUEHv4WcSQRxTdTqdrF279pYQFxGxWq3y4osv9hszOztbrl27FhLZCxculN617Q864DmUdNCgCMgb0tPTWb16NVFR/iNGp9NJTU0Nu3fv5ptvvuHw4cNcvnyZqKgooqOj0Wi87jgYDAZSUlIoKiriypUrpKam8tlnn5GcnBxQN5fLhc1mw+FwoNVq0Wq1g2S3tLRQWFioFxEdwI9qZ12j0ciaNWsCWrihoUFWrlwpI0eO7Pd7g8EgaWlpkpubK52dnX5lrF27Vkwmk3z88ccBx+vu7pbi4mJ55ZVX5P7775epU6dKTk6ObNu2bZDHHDlyRGJjYwUlBUaHWvIWi0UqKytVEV+8eLHk5ORIenq6GI3GfnLCwsJk1apVYrVafcqpr6+X1157TRobGwO68vr162XOnDkyadIkiY6O9owTHh4uzzzzjDQ0NHj6NzU1yT333OPuo36hy87OFrvd7lORGzduSH5+vtTU1Ijdbpfu7m5pbm6WV199VbRa7aCtcsOGDT5l9fT0SFtbm98YwuVyyebNm+WLL76QlpYWaW9vlx07dkhiYmK/sZ5++mlpb28XERG73S6PPvqoAKLqOwcldn/ooYcwGo0++xw6dIiysjLGjBmD0WhEr9eTkJDApEmT0On6xRVYrVbWrVtHQ0ODV1larZaYmBifawNAdXU1ubm5JCYmEh8fzx133EFqaioRERH9+m3fvp2vv/4aAKPRiMViAQYfbHwiLi6OyZMn+3wvIuzbt49NmzbR0dHBjBkzMBqNlJWVsXHjRrq7u70qf/jwYbKzs9Wq0Q979uzh6NGjvPzyyzz44IMYDAYOHTrE2bNn+/Wz2+3k5eWxePFiIiIiSExM/LvealpmZqa0trb6/fZmzpzpWRhNJpOEh4cPcveB7Y033gi4oPla5Hq3LVUtOTlZTpw4ISIi69atE0BUz/zYsWOJjY31+b67u5tr1655vMBut6uS29raioj4dW9vsNlstLa2qu7f1tbG9evXAYiIiECj0ajb2wHGjx/vV0G9Xk9YWPB3BsOGDQuauHs8vV713GE0Gj35BZPJBKgMbHQ6HaNHj/bbx2QyMWHChKAIaDQaxo8fHzRx93hjxoxR3d9sNjN8+HAATwJFFXmTyYTZbA5ooNmzZwc1+8nJyWRkZAyJvEajYdasWarHy8zM9Cx0DodDPfnIyMiA4SzA7NmzmTVrlmrlc3Jy+s283W7n2rVrXncGb5g1axYzZswI2M9isfDcc895wt2Ojg5EBFCxUiYlJUlNTY2qVfjYsWOSlpYWUObjjz8uly5d8qzcW7dulUceeUQyMzNl/vz5snLlStm2bZucOnXKb5bo6NGjfSO2QS02NlY2bNjQL1h6++231Ud4qampUldXp3obKi0tlblz50pYWJjXfN/y5culvr7e07+goEDi4uIG9dXr9ZKSkiLPP/+87N692xOleTN4VlaWxMbGikaj8YS29957r+Tl5Q0ynvvUqHFbwB9SU1MpLCwkJSVFlTuCsoXt37+f4uJizp8/j16vZ/z48cyZM4dp06YRHq7UFFitVrKzsykoKPArLyoqioyMDJYtW8a8efMYNmxYv/ednZ2UlZVRU1ODw+EgOTmZKVOm9AtoQNmSFy1a5Bkv4MynpKTI6dOnhxSMOJ1OsdlsYrfbvcbp5eXlg2Jxf23YsGGSlZUlJSUl4nQ6g9anpaVFpkyZot7tLRaLVFdXD4l8IOTn54tOr5fRIFFBHLJGjhwpH3zwgVy5ciWo8aqrq8VsNqs/2FitVqxWq2qXDwYXL13C1dPDQiCbAWlVP2hqauLdd99l6dKlVFRUqB7v3LlztLW1ASq3OqvVSmdn5y0hb+vqwiBCEvAHYL5apVC+34KCAp566ikKCws925c/lJeXY7PZPOQdgX7gcDi4ePHiLSGvNxjQajToUG5NVqKkktUHrlBVVcULL7xAXl6eXwPY7XbKy8s9z1qU+yu/6Onp4dy5c7eEfGxMDGg0dKPcJ8cDrwPPElyNWUNDAytWrGDnzp0++zQ3N/f9ROxalAqGgFemZ86cuSXkzWYzGqORdpRLNBcQDfwReBPlylgtmpqaWLVqFaWlpV7fV1RU9E2e/KJFuZ8LeDY8efIk7e3tISefmJjIHXFxNKGUboKynJuAhcB/AbN7n9Xg1KlTvP/++4N0FRF+/PFH98LtBAq0QBlwNJDQuro6Ll++HHLyFouFpKQkTqPUv3iU7W1pwAfAn4DxqFsMf/jhB/bv73cVT3NzM8XFxe7HemC3FiV7m49SVOgTLS0tHD9+POTko6OjmTRxInUo7jeQnAulDm4x8N/Aa8A4QO8nB9DV1TXI9Y8cOUJtba378Tug1j1WIQEWPrvdTklJScjJazQapt13H216PTV4vzyXXiOYUbbDXODNpCQeefhhzGbzoOSoyWTql39wOBzk5+fT1dUF0IZSeeJ07yiNwFaUu2ufccbhw4e5cuUK8fGhLXKcOnUqcRYLB8+eZYYPA7iNQK8RsiMi+OPatTTabFSUl3P8+HGam5sxGo1kZGSQlZXl+V1VVRVFRUXux0Lg54GyLUApfkLKyMhI2bdvX8hDXLvdLkuefFIsIIUg1SCVAVp5RIS0FhV5ZLhcLnE6nYMuM10ul7z++utuDpcBTwKg7yfW0OtRNl8z1NnZya5du0JeTGQ0Gnls/nxajEZ+VPkbndVKR3W151mj0aDT6Qbdz9XW1rJjxw7345fAIW/kAb5CKeb3iT179nD69OmQkgeYOXMmE9LS2IUyPYFSmgJcr6nxex53uVxs3rzZrW8VsI4+C/tA8h3AGpTaFa84c+aM3yhqqEhMTOSpnBxOaLXsVfkb19Wrft+XlpaydetWgBsoFdm1fd972zZ/QfmfjM+TzJYtW25JxLfk978nLT2dbSjWD7Sn2zs7PcnIgejo6OCTTz6hsbFRgM3A9oF9fMnfAmzg70FXP1RVVbFlyxZVp6hgMGrUKF5avpyLRiMbUKbLn/tfdzhwOp3eCWzZwrfffgtKrdFfUAoSVCMe2IaPf0lZLBb5+eefQ77yX716VR577DHRg6wAqQCp8rbag/zvww/LDS81eIcOHZLRo0cLUM6A4qNgkAzsxsfW98QTT0hbW1vIDfDTTz/J6N/9TiJB3gE5PsAAVSDFIH/JyZHuAamx06dPS2ZmpqB83/ffrDem+DKAwWCQDz/8cEi5tEDYtGmTREdHSzTIv4KUgNSA1PYa4E8gq995p99vLly4IAsWLBCgBnjoZom7kdT7CTgHGmD48OGSn58fcvJ2u13WrFkjkZGRoge5D+TPIJ+BLAdJjoqS777/3tP/zJkzsnDhQtFoNL8A00JF3I144CO81OulpqZKcXFxyA3Q1dUln376qbt8TDQght4xFy1aJNevXxcR5eJi+vTpTq1WW8At/JtZOPAvKDtRPwOMGzdOvu8zE6GC0+mUoqIiycrKEovFIiNGjJBFixZJbW2t9PT0yFdffSUTJkxoQ1nRE24VcTc0QDpKqGjta4BRo0bJ+vXrA1ZaDQVWq1VOnDghVVVV0tnZKZcvX5b33nvPaTabD6Ok/QxDpxQ8ooBngCP0+QNSeHi4ZGdnS0lJyZAqsQOhvb1d8vLyXPPmzauLiIh4E7jztyQ9EInAy8BPfT1hxIgR8uyzz8rOnTulvr5ebDbbkMi6XC6xWq1SWVkpubm53QsWLKiNj49fDdyN+iy3VwRfEuHfCP+MknjNoDftFhYWxtixY0lPTyczM5O0tDTGjRvnt8QFoL29nZMnT1JWVsaBAwdcZWVlVXV1ddsdDsd24CQqkq6B8H/fV61IfhLcyAAAACV0RVh0ZGF0ZTpjcmVhdGUAMjAxOS0wOC0xOFQxNDo0NTo1MCswMzowMHgVxioAAAAldEVYdGRhdGU6bW9kaWZ5ADIwMTktMDgtMThUMTQ6NDU6NTArMDM6MDAJSH6WAAAAGXRFWHRTb2Z0d2FyZQB3d3cuaW5rc2NhcGUub3Jnm+48GgAAAABJRU5ErkJggg==')
 
-_re_timer_tick = re.compile(rb'timer_tick\(ctx, [0-9]+\)')
+_re_timer_tick = re.compile(rb'timer_tick\(ctx, ([0-9]+)\)')
+_default_cache_control = "public, max-age=3600"
+_compressed_file_max_size = 1024 * 1024 # larger files are sent as they are
+
+_queue_policies = ("coalesce", "drop_oldest", "rerender", "disconnect")
+_dom_positions = ("beforebegin", "afterbegin", "beforeend", "afterend")
+
+_re_wait_server_event = re.compile(rb'/[^/]*/wait_server_event\(')
+_re_event_stream = re.compile(rb'/[^/]*/event_stream$')
+_re_session_worker = re.compile(rb'\.session-w([0-9]+)-')
+
+_http_max_head_size = 65536 # bytes in request line and headers
+_http_max_body_size = 16 * 1024 * 1024 # default max_request_size
 _re_python_attr = re.compile(r' python-(?P<js_event>on[a-zA-Z0-9]*)(\((?P<event_attrs>[a-zA-Z0-9, ]*)\))?="(?P<python>[^"]*)"')
 _re_python_event = re.compile(r'python-(?P<js_event>on[a-zA-Z0-9]*)')
 
@@ -186,86 +424,1085 @@ def _close(conn):
     except:
         pass
 
-def _http_send_ok(conn, s, headers={}):
+def _http_send_ok(conn, s, headers={}, compression=None):
+    """send s in 200 OK response. compression is None or (encoding,
+    level, threshold), see Protocol._compression."""
     if isinstance(s, bytes):
         s_bytes = s
     else:
         s_bytes = bytes(s, "utf-8")
+    if not compression is None:
+        # the response depends on Accept-Encoding, shared caches
+        # must not serve it to other browsers as it is
+        headers = dict(headers)
+        headers["Vary"] = "Accept-Encoding"
+        if not compression[0] is None and len(s_bytes) >= compression[2]:
+            s_bytes = _http_compress(s_bytes, compression[0], compression[1])
+            headers["Content-Encoding"] = compression[0]
+    return conn.sendall(_http_ok_head(len(s_bytes), headers) + s_bytes)
+
+def _http_accepted_encoding(request):
+    """returns "gzip" or "deflate" if the request accepts it,
+    otherwise None"""
+    accepted = {}
+    for item in request.headers.get(b"accept-encoding", b"").split(b","):
+        name, _, params = item.partition(b";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith(b"q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ("gzip", "deflate"):
+        if accepted.get(bytes(encoding, "ascii"), 0.0) > 0.0:
+            return encoding
+    return None
+
+def _http_compress(data, encoding, level):
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    else:
+        compressor = zlib.compressobj(level)
+    return compressor.compress(data) + compressor.flush()
+
+def _http_compressible(content_type):
+    if isinstance(content_type, bytes):
+        content_type = content_type.decode("latin-1")
+    return (content_type.startswith("text/") or
+            [t for t in ("javascript", "json", "xml", "svg") if t in content_type] != [])
+
+def _http_ok_head(content_length, headers={}):
+    """returns status line and headers of 200 OK response. Cache,
+    encoding and timing headers (see _http_cache_headers) are copied
+    from headers."""
     content_type = headers.get('Content-Type', b"text/html; charset=utf-8")
     if isinstance(content_type, str):
         content_type = bytes(content_type, "utf-8")
-    resp = (b"HTTP/1.1 200 OK\r\n"
+    return (b"HTTP/1.1 200 OK\r\n"
             b"Server: Hot Penguin\r\n"
             b"Keep-Alive: timeout=30\r\n"
             b"Connection: Keep-Alive\r\n"
+            b"%b"
             b"Content-Type: %b\r\n"
-            b"Content-Length: %d\r\n\r\n%s") % (content_type, len(s_bytes), s_bytes)
-    return conn.sendall(resp)
+            b"Content-Length: %d\r\n\r\n") % (_http_cache_headers(headers), content_type, content_length)
+
+def _http_cache_headers(headers):
+    lines = []
+    for name in ("Cache-Control", "ETag", "Last-Modified", "Content-Encoding", "Vary", "Server-Timing"):
+        value = headers.get(name, None)
+        if isinstance(value, str):
+            value = bytes(value, "utf-8")
+        if value:
+            lines.append(b"%b: %b\r\n" % (bytes(name, "utf-8"), value))
+    return b"".join(lines)
+
+def _http_server_timing(timing):
+    """returns Server-Timing header value of [(handler, wall seconds,
+    CPU seconds), ...]"""
+    metrics = []
+    for handler, wall, cpu in timing:
+        # desc is a quoted-string: printable ASCII without " and \
+        desc = re.sub(r'[^ !#-\[\]-~]', "?", handler[:80])
+        metrics.append('handler;dur=%.3f;desc="%s", cpu;dur=%.3f' % (wall * 1000, desc, cpu * 1000))
+    return ", ".join(metrics)
+
+def _http_send_not_modified(conn, headers):
+    return conn.sendall(b"HTTP/1.1 304 Not Modified\r\n"
+                        b"Server: Hot Penguin\r\n"
+                        b"Keep-Alive: timeout=30\r\n"
+                        b"Connection: Keep-Alive\r\n"
+                        b"%b\r\n" % (_http_cache_headers(headers),))
+
+def _http_not_modified(request, headers):
+    """returns True if the browser has the resource described by
+    ETag and Last-Modified in headers"""
+    if b"if-none-match" in request.headers:
+        etag = bytes(headers["ETag"], "utf-8")
+        etags = [tag.strip() for tag in request.headers[b"if-none-match"].split(b",")]
+        return b"*" in etags or etag in etags or b"W/" + etag in etags
+    if b"if-modified-since" in request.headers and "Last-Modified" in headers:
+        return request.headers[b"if-modified-since"].strip() == bytes(headers["Last-Modified"], "utf-8")
+    return False
 
 def _http_send_404(conn, s):
+    return _http_send_status(conn, b"404 Not found", s)
+
+def _http_send_status(conn, status, s):
     if isinstance(s, bytes):
         s_bytes = s
     else:
         s_bytes = bytes(s, "utf-8")
-    resp = (b"HTTP/1.1 404 Not found\r\n"
+    resp = (b"HTTP/1.1 %b\r\n"
             b"Server: Hot Penguin\r\n"
             b"Content-Type: text/html; charset=utf-8\r\n"
-            b"Content-Length: %d\r\n\r\n%s") % (len(s_bytes), s_bytes)
+            b"Content-Length: %d\r\n\r\n%s") % (status, len(s_bytes), s_bytes)
     return conn.sendall(resp)
 
-def _http_read(conn):
-    if repr(conn) in _http_read._read_too_far:
-        data = _http_read._read_too_far[repr(conn)]
-        del _http_read._read_too_far[repr(conn)]
-    else:
+class _HttpRequest(object):
+    """
+    Http request: method, path and version are bytes as they appear
+    on the request line, headers is {lowercase_name: value} bytes.
+    """
+    def __init__(self, method, path, version, headers, body=b""):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.timing = [] # [(handler, wall seconds, CPU seconds), ...]
+
+class _HttpParser(object):
+    """
+    Incremental parser for http requests received from a connection.
+
+    Received bytes are collected to a buffer that is reused for all
+    requests on the connection. The request line and headers are
+    parsed once when they have been received completely, the body is
+    sliced out of the buffer when Content-Length bytes are there.
+    """
+    def __init__(self, max_body_size=_http_max_body_size):
+        self._buf = bytearray()
+        self._scanned = 0 # there is no end of head in self._buf[:self._scanned]
+        self._request = None # request with a parsed head, waiting for body
+        self._body_size = 0
+        self._max_body_size = max_body_size
+
+    def feed(self, data):
+        self._buf += data
+
+    def read_request(self, sock, chunk):
+        """returns next request received from blocking sock, or None
+        if the connection has been lost. chunk is a memoryview to a
+        receive buffer."""
+        request = self.next_request()
+        while request is None:
+            try:
+                received = sock.recv_into(chunk)
+            except OSError:
+                return None
+            if received == 0:
+                return None
+            self._buf += chunk[:received]
+            request = self.next_request()
+        return request
+
+    def next_request(self):
+        """returns next request if it has been received completely,
+        otherwise None. Raises ProtocolError on invalid requests."""
+        if self._request is None:
+            while self._buf.startswith(b"\r\n"): # allowed before request line
+                del self._buf[:2]
+            head_end = self._buf.find(b"\r\n\r\n", max(0, self._scanned - 3))
+            if head_end == -1:
+                self._scanned = len(self._buf)
+                if self._scanned > _http_max_head_size:
+                    raise ProtocolError("request header too large")
+                return None
+            if head_end > _http_max_head_size:
+                raise ProtocolError("request header too large")
+            self._request, self._body_size = self._parse_head(bytes(self._buf[:head_end]))
+            del self._buf[:head_end + 4]
+            self._scanned = 0
+        if len(self._buf) < self._body_size:
+            return None
+        request, self._request = self._request, None
+        request.body = bytes(self._buf[:self._body_size])
+        del self._buf[:self._body_size]
+        return request
+
+    def remaining(self):
+        """returns and forgets received bytes that are not part of
+        parsed requests, for instance when switching protocols"""
+        data = bytes(self._buf)
+        self._buf.clear()
+        self._scanned = 0
+        return data
+
+    def _parse_head(self, head):
+        lines = head.split(b"\r\n")
         try:
-            data = conn.recv(4096)
-        except:
-            data = b""
-    if data == b"":
-        return b""
-    if data != b"" and len(data) < 4 and not (data.startswith(b"GET") or data.startswith(b"POST")):
-        data += conn.recv(4096)
-    if data.startswith(b"POST"): # require content-length in POST
-        while not b"content-length" in data.lower():
-            data += conn.recv(4096)
-        while not b"\r\n\r\n" in data:
-            data += conn.recv(4096)
-    datarows = data.split(b'\n')
-    datalength = 0
-    datahead, databody = data, b""
-    for row in datarows:
-        if row.lower().startswith(b'content-length'):
-            datalength = int(row.strip().split()[1])
-            datahead, databody = data.split(b'\r\n\r\n', 1)
-            break
-    while len(databody) < datalength:
-        databody += conn.recv(4096)
-    if len(databody) > datalength:
-        _http_read._read_too_far[repr(conn)] = databody[datalength:]
-        databody = databody[:datalength]
-    return datahead + b'\r\n\r\n' + databody
-_http_read._read_too_far = {}
-
-def _session_id_new():
-    session_id =  b".session-%f" % (time.time(),)
+            method, path, version = lines[0].split(b" ")
+        except ValueError:
+            raise ProtocolError("invalid request line %r" % (lines[0][:42],))
+        headers = {}
+        for line in lines[1:]:
+            name, colon, value = line.partition(b":")
+            if not colon:
+                raise ProtocolError("invalid header line %r" % (line[:42],))
+            headers[name.strip().lower()] = value.strip()
+        try:
+            body_size = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            raise ProtocolError("invalid Content-Length")
+        if body_size < 0:
+            raise ProtocolError("invalid Content-Length")
+        if body_size > self._max_body_size:
+            raise ProtocolError("request body too large (%d bytes)" % (body_size,))
+        return _HttpRequest(method, path, version, headers), body_size
+
+_websocket_guid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def _http_request_bytes(request):
+    """returns request as it was received, headers in lowercase"""
+    return b"".join([b"%s %s %s\r\n" % (request.method, request.path, request.version)] +
+                    [b"%s: %s\r\n" % (name, value) for name, value in request.headers.items()] +
+                    [b"\r\n", request.body])
+
+def _websocket_upgrade(request):
+    """returns True if request asks to switch to websocket protocol"""
+    return request.headers.get(b"upgrade", b"").lower() == b"websocket"
+
+def _websocket_frame(payload, opcode=0x1):
+    """returns unmasked websocket frame, text frame by default"""
+    if isinstance(payload, str):
+        payload = bytes(payload, "utf-8")
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+def _websocket_unmask(mask, payload):
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "little") ^
+            int.from_bytes(key, "little")).to_bytes(length, "little")
+
+class _WebSocketParser(object):
+    """
+    Incremental parser for websocket messages received from a
+    browser. Fragmented messages are joined, control frames are
+    returned as they arrive.
+    """
+    def __init__(self, max_message_size=_http_max_body_size):
+        self._buf = bytearray()
+        self._fragments = []
+        self._fragments_opcode = None
+        self._max_message_size = max_message_size
+
+    def feed(self, data):
+        self._buf += data
+
+    def read_message(self, sock, chunk):
+        """returns next (opcode, payload) received from blocking sock,
+        or None if the connection has been lost"""
+        message = self.next_message()
+        while message is None:
+            try:
+                received = sock.recv_into(chunk)
+            except OSError:
+                return None
+            if received == 0:
+                return None
+            self._buf += chunk[:received]
+            message = self.next_message()
+        return message
+
+    def next_message(self):
+        """returns next (opcode, payload) if it has been received
+        completely, otherwise None. Raises ProtocolError on invalid
+        frames."""
+        while 1:
+            buf = self._buf
+            if len(buf) < 2:
+                return None
+            fin, opcode = buf[0] & 0x80, buf[0] & 0x0f
+            if not buf[1] & 0x80:
+                raise ProtocolError("unmasked websocket frame from browser")
+            length, offset = buf[1] & 0x7f, 2
+            if length == 126:
+                if len(buf) < 4:
+                    return None
+                length, offset = struct.unpack_from("!H", buf, 2)[0], 4
+            elif length == 127:
+                if len(buf) < 10:
+                    return None
+                length, offset = struct.unpack_from("!Q", buf, 2)[0], 10
+            if length > self._max_message_size:
+                raise ProtocolError("websocket message too large (%d bytes)" % (length,))
+            if len(buf) < offset + 4 + length:
+                return None
+            mask = bytes(buf[offset:offset + 4])
+            payload = _websocket_unmask(mask, bytes(buf[offset + 4:offset + 4 + length]))
+            del buf[:offset + 4 + length]
+            if opcode >= 0x8: # control frame, cannot be fragmented
+                return opcode, payload
+            if opcode != 0x0:
+                self._fragments_opcode = opcode
+            elif self._fragments_opcode is None:
+                raise ProtocolError("unexpected websocket continuation frame")
+            self._fragments.append(payload)
+            if fin:
+                message = (self._fragments_opcode, b"".join(self._fragments))
+                self._fragments, self._fragments_opcode = [], None
+                return message
+
+def _sse_frame(payload):
+    """returns server-sent event that carries payload as data"""
+    payload = payload.replace("\r\n", "\n").replace("\r", "\n")
+    return bytes("data: " + payload.replace("\n", "\ndata: ") + "\n\n", "utf-8")
+
+def _session_id_new(worker=None):
+    if worker is None:
+        session_id =  b".session-%f" % (time.time(),)
+    else:
+        session_id =  b".session-w%d-%f" % (worker, time.time())
     return session_id
 
+def _session_id_worker(session_id):
+    """returns number of the worker process that owns the session,
+    or None if the session id does not tell it"""
+    match = _re_session_worker.match(session_id)
+    if match:
+        return int(match.group(1))
+    return None
+
 def _session_id_valid(session_id):
     if session_id.startswith(b".session-"):
         return True
     else:
         return False
 
-def _path_parse(http_request):
-    """parse path from http request"""
-    first_line = http_request.split(b'\n', 1)[0] # it's on the first row
+def _hostspec_host_port(hostspec):
+    """returns (host, port) of "host:port" """
     try:
-        # between two spaces: GET<space>addr<space>HTTP/1.1
-        path = first_line.split(b'GET ')[1].split(b' HTTP/')[0].decode('utf-8')
-    except IndexError as e:
-        path = ""
-    return path
+        host, port_s = hostspec.split(":")
+        port = int(port_s)
+    except Exception as e:
+        raise Exception("invalid hostspec %r: %s" % (hostspec, e))
+    return host, port
+
+def _check_session_options(kw):
+    if not kw.get("queue_policy", "coalesce") in _queue_policies:
+        raise ValueError('invalid queue_policy %r, expected one of %s' % (kw["queue_policy"], ", ".join(_queue_policies)))
+
+def _path_parse(request):
+    """parse path from http request"""
+    if request.method != b"GET":
+        return ""
+    return request.path.decode('utf-8')
+
+def _update_key(name):
+    """returns (element_id, attr) key of a Page.update() name"""
+    if name.startswith("window."):
+        return (None, name)
+    elif "." in name:
+        return tuple(name.split(".", 1))
+    else:
+        return (name, "innerHTML")
+
+def _update_entries(name_content_dict, tokenize_html=None):
+    """returns [(name, browser_queue_entry)] that implement
+    Page.update(name_content_dict). Inner HTMLs are tokenized with
+    tokenize_html, if given."""
+    entries = []
+    for name in name_content_dict:
+        if name == "js":
+            # run raw javascript
+            entries.append((name, ("js", None, _browser_op("js", name_content_dict[name]))))
+        elif name.startswith("window."):
+            # direct access to some javascript objects
+            # example: {"window.location.href": "http://new/url"}
+            entries.append((name, ("set", _update_key(name), _browser_op(
+                "window", name[len("window."):], name_content_dict[name]))))
+        elif "." in name:
+            # replace an attribute
+            # example: {"myEltID.myEltAttr": "new value"}
+            eid, attr = name.split(".", 1)
+            if not "-" in attr and not " " in attr:
+                entries.append((name, ("set", _update_key(name), _browser_op(
+                    "set", eid, attr, name_content_dict[name]))))
+            else:
+                entries.append((name, ("set", _update_key(name), _browser_op(
+                    "attr", eid, attr, name_content_dict[name]))))
+        else:
+            # replace contents of element
+            # example: {"myDivID": "new html"}
+            content = name_content_dict[name]
+            if not tokenize_html is None:
+                content = tokenize_html(content)
+            entries.append((name, ("set", _update_key(name), _browser_op(
+                "set", name, "innerHTML", content))))
+    return entries
+
+def _browser_op(*op):
+    """returns JSON of an [op, args...] operation that apply_ops()
+    runs on the browser"""
+    return json.dumps(op, ensure_ascii=False, separators=(",", ":"))
+
+def _browser_ops(codes):
+    """returns JSON array of operations in codes, each code being
+    zero or more comma-separated _browser_op()s"""
+    codes = [code for code in codes if code]
+    if not codes:
+        return ""
+    return "[%s]" % (",".join(codes),)
+
+def _coalesced_browser_queue(queue):
+    """returns JSON operations of updates in the browser queue.
+
+    Queue entries are (kind, key, code) tuples, code is JSON of
+    operations, see _browser_ops. Between two "js", "dom" or "page"
+    entries only the last "set" of each key (element id, attribute)
+    is kept.
+    Element updates right before a page switch are dropped, because
+    the new page replaces the elements."""
+    return _browser_ops([code for kind, key, code in _coalesced_browser_queue_entries(queue)])
+
+def _coalesced_browser_queue_entries(queue):
+    """returns entries of the browser queue that are left after
+    coalescing, see _coalesced_browser_queue"""
+    entries = []
+    latest = {} # {key: index in entries} since the last "js", "dom" or "page"
+    for entry in queue:
+        kind, key, code = entry
+        if kind == "set":
+            if key in latest:
+                entries[latest[key]] = None
+            latest[key] = len(entries)
+        else:
+            if kind == "page":
+                for key, index in latest.items():
+                    if not key[0] is None: # not a window.* update
+                        entries[index] = None
+            latest.clear()
+        entries.append(entry)
+    return [entry for entry in entries if not entry is None]
+
+class _LoopConnection(object):
+    """
+    Non-blocking TCP connection served by _EventLoop. Like on
+    sockets, sendall() and close() can be called from any thread.
+    """
+    def __init__(self, loop, sock, host_port, options):
+        self.sock = sock
+        self.host_port = host_port
+        self.options = options
+        self.parked_session = None # session waiting to respond to this
+        self.stream_session = None # session sending its browser queue to this
+        self._loop = loop
+        self._parser = _HttpParser(loop._protocol._max_request_size)
+        self._websocket = None # _WebSocketParser after switching protocols
+        self._outbuf = bytearray()
+        self._outbuf_lock = _thread.allocate_lock()
+        self._outfile = None # (fd, offset, end) to be sent after _outbuf
+        self._busy = False # request is being handled outside the loop
+        self._closing = False
+        self._closed = False
+        self._events = selectors.EVENT_READ
+
+    def sendall(self, data):
+        self._outbuf_lock.acquire()
+        try:
+            if self._closed:
+                log("dropped %d bytes to a closed connection" % (len(data),))
+                return
+            self._outbuf += data
+        finally: self._outbuf_lock.release()
+        self._loop.wake(self)
+
+    def sendfile(self, file, offset=0, count=None):
+        """send count bytes of file starting from offset after data
+        given to sendall(). Unlike socket.sendfile(), returns before
+        the file has been sent, the file can be closed right away.
+        Next requests are handled when the file has been sent."""
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        if count <= 0:
+            return
+        fd = os.dup(file.fileno())
+        self._outbuf_lock.acquire()
+        try:
+            if self._closed:
+                os.close(fd)
+                return
+            self._outfile = (fd, offset, offset + count)
+            self._busy = True
+        finally: self._outbuf_lock.release()
+        self._loop.wake(self)
+
+    def close(self):
+        """close the connection when everything has been sent"""
+        self._closing = True
+        self._loop.wake(self)
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class _EventLoop(object):
+    """
+    Serves all connections of a Protocol in a single thread. Requests
+    that evaluate Python callbacks are handled in short-lived threads,
+    browsers waiting for server events are parked in their sessions
+    without reserving a thread.
+    """
+    def __init__(self, protocol):
+        self._protocol = protocol
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._woken = set()
+        self._woken_lock = _thread.allocate_lock()
+        self._calls = [] # functions to be called in the loop thread
+        self._timers = [] # heap of (time, sequence number, func, args), see call_later
+        self._timer_count = 0
+        self._chunk = memoryview(bytearray(65536)) # receive buffer
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread_id = None
+        _thread.start_new_thread(self._run, ())
+
+    def listen(self, sock, host_port, options):
+        sock.setblocking(False)
+        self.call_soon(self._selector.register, sock, selectors.EVENT_READ,
+                       (host_port, options))
+
+    def adopt(self, sock, host_port, options, received):
+        """serve a connection accepted by another process, received
+        bytes have already been read from it"""
+        sock.setblocking(False)
+        self.call_soon(self._adopt, sock, host_port, options, received)
+
+    def call_soon(self, func, *args):
+        self._woken_lock.acquire()
+        try:
+            self._calls.append((func, args))
+        finally: self._woken_lock.release()
+        self._signal()
+
+    def call_later(self, delay, func, *args):
+        """call func(*args) in the loop thread after delay seconds"""
+        self._woken_lock.acquire()
+        try:
+            self._timer_count += 1
+            heapq.heappush(self._timers, (time.time() + delay, self._timer_count, func, args))
+        finally: self._woken_lock.release()
+        self._signal()
+
+    def wake(self, conn):
+        """update conn in the loop: send output, close or read more"""
+        self._woken_lock.acquire()
+        try:
+            self._woken.add(conn)
+        finally: self._woken_lock.release()
+        if _thread.get_ident() != self._thread_id:
+            self._signal()
+
+    def _signal(self):
+        try:
+            self._wake_w.send(b"x")
+        except (BlockingIOError, InterruptedError):
+            pass # the loop has not read previous signals yet
+
+    def _run(self):
+        self._thread_id = _thread.get_ident()
+        while 1:
+            timeout = None
+            if self._timers:
+                timeout = max(0.0, self._timers[0][0] - time.time())
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096): pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                elif isinstance(key.data, _LoopConnection):
+                    if mask & selectors.EVENT_READ:
+                        self._serve(self._read, key.data)
+                    if mask & selectors.EVENT_WRITE:
+                        self._serve(self._write, key.data)
+                else:
+                    self._accept(key.fileobj, *key.data)
+            if self._timers:
+                now = time.time()
+                self._woken_lock.acquire()
+                try:
+                    while self._timers and self._timers[0][0] <= now:
+                        when, count, func, args = heapq.heappop(self._timers)
+                        self._calls.append((func, args))
+                finally: self._woken_lock.release()
+            while self._woken or self._calls:
+                self._woken_lock.acquire()
+                try:
+                    woken, self._woken = self._woken, set()
+                    calls, self._calls = self._calls, []
+                finally: self._woken_lock.release()
+                for func, args in calls:
+                    try:
+                        func(*args)
+                    except Exception as e:
+                        log("event loop: %s failed: %s" % (func, e))
+                for conn in woken:
+                    self._serve(self._update, conn)
+
+    def _serve(self, func, conn):
+        """func(conn) that fails closes only conn, not the loop"""
+        if conn._closed:
+            return
+        try:
+            func(conn)
+        except Exception as e:
+            log("event loop: connection to %s failed: %s\n%s" % (conn.host_port, e, traceback.format_exc()))
+            self._close(conn)
+
+    def _accept(self, sock, host_port, options):
+        while 1:
+            try:
+                s, src = sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log("accepting connection to %s failed: %s" % (host_port, e))
+                return
+            s.setblocking(False)
+            log("serving connection to %s from %s" % (host_port, src))
+            self._protocol._metrics.inc("httpgui_connections_accepted_total")
+            conn = _LoopConnection(self, s, host_port, options)
+            self._selector.register(s, selectors.EVENT_READ, conn)
+
+    def _adopt(self, sock, host_port, options, received):
+        conn = _LoopConnection(self, sock, host_port, options)
+        self._selector.register(sock, selectors.EVENT_READ, conn)
+        conn._parser.feed(received)
+        self._serve(self._handle_requests, conn)
+
+    def _read(self, conn):
+        try:
+            received = conn.sock.recv_into(self._chunk)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if received == 0: # connection lost
+            self._close(conn)
+            return
+        if conn._websocket is None:
+            conn._parser.feed(self._chunk[:received])
+        else:
+            conn._websocket.feed(self._chunk[:received])
+        self._handle_requests(conn)
+
+    def _write(self, conn):
+        conn._outbuf_lock.acquire()
+        try:
+            if conn._outbuf:
+                try:
+                    sent = conn.sock.send(conn._outbuf)
+                    del conn._outbuf[:sent]
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    conn._outbuf.clear()
+                    conn._closing = True
+            if not conn._outbuf and not conn._outfile is None:
+                self._write_file(conn)
+            pending_output = bool(conn._outbuf) or not conn._outfile is None
+        finally: conn._outbuf_lock.release()
+        if conn._closing and not pending_output:
+            self._close(conn)
+        elif not conn._closed:
+            events = selectors.EVENT_READ
+            if pending_output:
+                events |= selectors.EVENT_WRITE
+            if events != conn._events:
+                self._selector.modify(conn.sock, events, conn)
+                conn._events = events
+
+    def _write_file(self, conn):
+        fd, offset, end = conn._outfile
+        try:
+            if hasattr(os, "sendfile"):
+                sent = os.sendfile(conn.sock.fileno(), fd, offset, min(end - offset, 1 << 20))
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                sent = conn.sock.send(os.read(fd, min(end - offset, 65536)))
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            sent = 0
+            conn._closing = True
+        offset += sent
+        if sent == 0 or offset >= end: # done, or the file has shrunk
+            os.close(fd)
+            conn._outfile = None
+            conn._busy = False
+            self.wake(conn) # handle next requests
+        else:
+            conn._outfile = (fd, offset, end)
+
+    def _update(self, conn):
+        if conn._closed:
+            return
+        self._write(conn)
+        if not conn._closed:
+            self._handle_requests(conn)
+
+    def _close(self, conn):
+        if conn._closed:
+            return
+        conn._outbuf_lock.acquire()
+        try:
+            conn._closed = True
+            if not conn._outfile is None:
+                os.close(conn._outfile[0])
+                conn._outfile = None
+        finally: conn._outbuf_lock.release()
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        _close(conn.sock)
+        if conn.parked_session:
+            conn.parked_session._unpark_delayed_response(conn)
+        if conn.stream_session:
+            conn.stream_session._close_stream(conn)
+
+    def _handle_requests(self, conn):
+        if not conn._websocket is None:
+            return self._handle_websocket_messages(conn)
+        while not conn._busy and not conn._closing:
+            try:
+                request = conn._parser.next_request()
+            except ProtocolError as e:
+                log("bad request from %s: %s" % (conn.getpeername(), e))
+                self._protocol._metrics.inc("httpgui_parse_errors_total", labels=(("kind", "http"),))
+                _http_send_status(conn, b"400 Bad Request", str(e))
+                conn.close()
+                return
+            if request is None:
+                return
+            sess = self._protocol._route_request(conn, request, conn.host_port, conn.options, conn._parser)
+            if sess is True:
+                continue
+            elif sess is False:
+                conn.close()
+            elif _re_wait_server_event.match(request.path):
+                sess._park_delayed_response(conn, self._protocol._compression(request))
+            elif _re_event_stream.match(request.path):
+                conn.stream_session = sess
+                sess._accept_event_stream(conn)
+            elif _websocket_upgrade(request):
+                conn.stream_session = sess
+                if not sess._accept_websocket(conn, request):
+                    conn.close()
+                    return
+                conn._websocket = _WebSocketParser(self._protocol._max_request_size)
+                conn._websocket.feed(conn._parser.remaining())
+                return self._handle_websocket_messages(conn)
+            else:
+                # Python callbacks may take time, do not block the loop
+                conn._busy = True
+                self._protocol._callbacks.submit(sess, self._handle_session_request, conn, sess, request)
+
+    def _handle_session_request(self, conn, sess, request):
+        try:
+            response = sess._handle_http_data(request)
+            if response is None:
+                conn.close()
+            else:
+                _http_send_ok(conn, response, headers=self._protocol._timing_headers(request),
+                              compression=self._protocol._compression(request))
+        finally:
+            conn._busy = False
+            self.wake(conn)
+
+    def _handle_websocket_messages(self, conn):
+        sess = conn.stream_session
+        while not conn._busy and not conn._closing:
+            try:
+                message = conn._websocket.next_message()
+            except ProtocolError as e:
+                log("bad websocket message from %s: %s" % (conn.getpeername(), e))
+                self._protocol._metrics.inc("httpgui_parse_errors_total", labels=(("kind", "websocket"),))
+                conn.close()
+                return
+            if message is None:
+                return
+            opcode, payload = message
+            if opcode >= 0x8: # control frames are answered right away
+                if not sess._handle_websocket_message(conn, opcode, payload):
+                    conn.close()
+            else:
+                conn._busy = True
+                self._protocol._callbacks.submit(sess, self._handle_websocket_message, conn, sess, opcode, payload)
+
+    def _handle_websocket_message(self, conn, sess, opcode, payload):
+        try:
+            if not sess._handle_websocket_message(conn, opcode, payload):
+                conn.close()
+        finally:
+            conn._busy = False
+            self.wake(conn)
+
+class _CallbackPool(object):
+    """
+    Runs Python callbacks of sessions in at most workers threads.
+    Callbacks with the same key (session) are run one at a time in
+    the order they were submitted, callbacks with different keys in
+    parallel. If workers is 0, the number of threads is not limited.
+    """
+    def __init__(self, workers):
+        self._workers = workers
+        self._lock = _thread.allocate_lock()
+        self._jobs = {} # {key: deque([(func, args, submit_time), ...])}
+        self._running_keys = {} # {key: ident of the thread running a job of key}
+        self._ready = collections.deque() # keys with jobs waiting for a worker
+        self._idle = [] # wakeup locks of idle worker threads
+        self._threads = 0
+        self._running = 0
+        self._queued = 0
+        self._submitted = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def submit(self, key, func, *args):
+        """run func(*args) in a worker thread"""
+        wakeup = None
+        start_thread = False
+        self._lock.acquire()
+        try:
+            if key in self._jobs:
+                # a job of key is queued or running, keep the order
+                self._jobs[key].append((func, args, time.time()))
+            else:
+                self._jobs[key] = collections.deque([(func, args, time.time())])
+                self._ready.append(key)
+                if self._idle:
+                    wakeup = self._idle.pop()
+                elif self._workers == 0 or self._threads < self._workers:
+                    self._threads += 1
+                    start_thread = True
+            self._queued += 1
+            self._submitted += 1
+        finally: self._lock.release()
+        if not wakeup is None:
+            wakeup.release()
+        elif start_thread:
+            _thread.start_new_thread(self._work, ())
+
+    def call(self, key, func, *args):
+        """run func(*args) in a worker thread, wait for it to finish
+        and return its return value. Returns None if func raised an
+        exception. If the number of workers is not limited and no
+        job of key is queued or running, func is called in this
+        thread. Either way it runs after jobs of key submitted
+        before, and before jobs submitted after it. A job of key
+        that calls call() with key would wait for itself, func is
+        called right away in its thread instead."""
+        ident = _thread.get_ident()
+        self._lock.acquire()
+        try:
+            nested = self._running_keys.get(key, None) == ident
+            inline = not nested and self._workers == 0 and not key in self._jobs
+            if inline:
+                # jobs of key submitted meanwhile wait for this call
+                self._jobs[key] = collections.deque()
+                self._running_keys[key] = ident
+                self._running += 1
+                self._submitted += 1
+        finally: self._lock.release()
+        if nested:
+            return func(*args)
+        if inline:
+            try:
+                return func(*args)
+            finally: self._call_done(key)
+        done = _thread.allocate_lock()
+        done.acquire()
+        result = []
+        def job():
+            try:
+                result.append(func(*args))
+            finally: done.release()
+        self.submit(key, job)
+        done.acquire()
+        return result[0] if result else None
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {"workers": self._workers,
+                    "threads": self._threads,
+                    "running": self._running,
+                    "queued": self._queued,
+                    "submitted": self._submitted,
+                    "completed": self._completed,
+                    "wait_seconds_total": self._wait_total,
+                    "wait_seconds_max": self._wait_max}
+        finally: self._lock.release()
+
+    def _call_done(self, key):
+        """hand key over to a worker thread if jobs were submitted
+        while call() ran a job of key in its own thread"""
+        wakeup = None
+        start_thread = False
+        self._lock.acquire()
+        try:
+            self._running -= 1
+            self._completed += 1
+            del self._running_keys[key]
+            if self._jobs[key]:
+                self._ready.append(key)
+                if self._idle:
+                    wakeup = self._idle.pop()
+                else:
+                    self._threads += 1
+                    start_thread = True
+            else:
+                del self._jobs[key]
+        finally: self._lock.release()
+        if not wakeup is None:
+            wakeup.release()
+        elif start_thread:
+            _thread.start_new_thread(self._work, ())
+
+    def _work(self):
+        wakeup = _thread.allocate_lock()
+        wakeup.acquire()
+        while 1:
+            self._lock.acquire()
+            try:
+                if not self._ready:
+                    if self._workers == 0:
+                        self._threads -= 1
+                        return
+                    self._idle.append(wakeup)
+                    key = None
+                else:
+                    key = self._ready.popleft()
+                    func, args, submit_time = self._jobs[key].popleft()
+                    self._running_keys[key] = _thread.get_ident()
+                    self._queued -= 1
+                    self._running += 1
+                    waited = time.time() - submit_time
+                    self._wait_total += waited
+                    self._wait_max = max(self._wait_max, waited)
+            finally: self._lock.release()
+            if key is None:
+                wakeup.acquire()
+                continue
+            try:
+                func(*args)
+            except Exception as e:
+                log("callback %s failed: %s\n%s" % (func, e, traceback.format_exc()))
+            self._lock.acquire()
+            try:
+                self._running -= 1
+                self._completed += 1
+                del self._running_keys[key]
+                if self._jobs[key]:
+                    self._ready.append(key)
+                else:
+                    del self._jobs[key]
+            finally: self._lock.release()
+
+_metrics_latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_metrics_size_buckets = (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_metrics_info = { # {name: (type, help, histogram buckets)}
+    "httpgui_connections_accepted_total": ("counter", "TCP connections accepted", None),
+    "httpgui_connections_handed_over_total": ("counter", "Connections handed over to the worker process that owns their session", None),
+    "httpgui_sessions_created_total": ("counter", "Sessions created", None),
+    "httpgui_sessions_closed_total": ("counter", "Sessions closed", None),
+    "httpgui_sessions_active": ("gauge", "Sessions open now", None),
+    "httpgui_long_polls_parked": ("gauge", "wait_server_event requests waiting for updates", None),
+    "httpgui_streams_open": ("gauge", "Open websockets and event streams", None),
+    "httpgui_browser_queue_entries": ("gauge", "Updates waiting in browser queues", None),
+    "httpgui_flush_entries": ("histogram", "Browser queue entries per flush, before coalescing", _metrics_size_buckets),
+    "httpgui_flush_bytes": ("histogram", "Bytes of browser operations per flush", _metrics_size_buckets),
+    "httpgui_event_seconds": ("histogram", "Event handler run time by handler", _metrics_latency_buckets),
+    "httpgui_timer_ticks_total": ("counter", "timer_tick events received", None),
+    "httpgui_parse_errors_total": ("counter", "Requests, websocket messages and events that could not be parsed", None),
+    "httpgui_callbacks_queued": ("gauge", "Callbacks waiting for a worker", None),
+    "httpgui_callbacks_running": ("gauge", "Callbacks running", None),
+    "httpgui_callback_wait_seconds_total": ("counter", "Time callbacks have waited for a worker", None),
+}
+
+class _Metrics(object):
+    """
+    Counters and histograms of a Protocol. Metrics are identified by
+    name and labels, a tuple of (label_name, value) pairs.
+    """
+    def __init__(self):
+        self._lock = _thread.allocate_lock()
+        self._values = {} # {name: {labels: counter value or [bucket counts, sum, count]}}
+
+    def inc(self, name, value=1, labels=()):
+        self._lock.acquire()
+        try:
+            values = self._values.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + value
+        finally: self._lock.release()
+
+    def observe(self, name, value, labels=()):
+        buckets = _metrics_info[name][2]
+        self._lock.acquire()
+        try:
+            values = self._values.setdefault(name, {})
+            histogram = values.get(labels, None)
+            if histogram is None:
+                histogram = values[labels] = [[0] * len(buckets), 0.0, 0]
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+        finally: self._lock.release()
+
+    def snapshot(self):
+        """returns {name: {labels: value}}. Histogram values are
+        {"buckets": [(le, cumulative count), ...], "sum": s, "count": n}"""
+        self._lock.acquire()
+        try:
+            snapshot = {}
+            for name, values in self._values.items():
+                buckets = _metrics_info[name][2]
+                snapshot[name] = {}
+                for labels, value in values.items():
+                    if buckets is None:
+                        snapshot[name][labels] = value
+                    else:
+                        cumulative, counts = 0, []
+                        for le, count in zip(buckets, value[0]):
+                            cumulative += count
+                            counts.append((le, cumulative))
+                        counts.append((float("inf"), value[2]))
+                        snapshot[name][labels] = {"buckets": counts, "sum": value[1], "count": value[2]}
+            return snapshot
+        finally: self._lock.release()
+
+def _metrics_text(snapshot):
+    """returns metrics snapshot in Prometheus text format"""
+    def label_text(labels):
+        if not labels:
+            return ""
+        return "{%s}" % (",".join(['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                                   for name, value in labels]),)
+    lines = []
+    for name in sorted(snapshot):
+        metric_type, help_text, buckets = _metrics_info[name]
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        for labels, value in sorted(snapshot[name].items()):
+            if buckets is None:
+                lines.append("%s%s %s" % (name, label_text(labels), value))
+                continue
+            for le, count in value["buckets"]:
+                le_text = "+Inf" if le == float("inf") else repr(le)
+                lines.append("%s_bucket%s %d" % (name, label_text(labels + (("le", le_text),)), count))
+            lines.append("%s_sum%s %s" % (name, label_text(labels), value["sum"]))
+            lines.append("%s_count%s %d" % (name, label_text(labels), value["count"]))
+    return "\n".join(lines) + "\n"
 
 class Protocol(object):
     """
@@ -282,7 +1519,70 @@ class Protocol(object):
                    "myimage.jpg": {"Content-Type": "image/jpeg",
                                    "data": open("myimage.jpg", "rb").read()}
                 })
+
+            # Resources can be served from files, too. Files are read
+            # when requested, Content-Type is guessed from the file
+            # name if not given. Browsers may cache resources for
+            # an hour (default Cache-Control), after that they
+            # check if ETag or Last-Modified has changed.
+            p = Protocol(common_resources={
+                   "/static/style.css": {"file": "static/style.css"},
+                   "/static/logo.png": {"file": "static/logo.png",
+                                        "Cache-Control": "max-age=86400"}
+                })
             s = p.new_session("localhost:8080")
+
+            # Serve all connections in one event loop thread instead
+            # of starting a thread for each connection. Browsers
+            # waiting for server events do not reserve a thread.
+            p = Protocol(engine="selectors")
+
+            # Compress responses of at least 1 kB with gzip or
+            # deflate, if the browser accepts them. Compressed copies
+            # of common resources are cached.
+            p = Protocol(compression_threshold=1024, compression_level=6)
+
+            # Serve counters and histograms of connections, sessions,
+            # browser queues and event handlers in Prometheus text
+            # format at /.httpgui/metrics. See also metrics().
+            p = Protocol(serve_metrics=True)
+
+            # Record calls, wall and CPU time of every event handler,
+            # see handler_stats(). Log handlers that run longer than
+            # 0.5 seconds with their stack. Tell run times of event
+            # handlers to the browser in Server-Timing headers, shown
+            # by browser developer tools. See also
+            # Session.start_profiling().
+            p = Protocol(profile_handlers=True, slow_handler_threshold=0.5,
+                         server_timing=True)
+
+            # Refuse requests with body larger than 64 kB
+            p = Protocol(max_request_size=65536)
+
+            # Run Python callbacks in at most 8 threads. Callbacks of
+            # a session are run in order, callbacks of different
+            # sessions in parallel. By default the number of threads
+            # is not limited. See callback_stats().
+            p = Protocol(callback_workers=8)
+
+            # Close sessions whose browser has not been heard of in
+            # 10 minutes. Browsers waiting for server events get an
+            # empty response every 3 minutes (keepalive_interval,
+            # default: session_timeout / 3) and send a new request.
+            # on_session_closed(session) is called for every closed
+            # session.
+            p = Protocol(session_timeout=600, keepalive_interval=180,
+                         on_session_closed=forget_user)
+
+            # Wait at most 0.2 seconds for the first page of a new
+            # session before responding with the base page, so that
+            # the page is shown without another round trip. 0 sends
+            # the base page right away. Default: 0.1.
+            p = Protocol(first_page_wait=0.2)
+
+            # Serve sessions in 4 processes, see fork_workers().
+            p = Protocol(engine="selectors")
+            p.fork_workers(4)
         """
         self.name = "Protocol"
         self._sockets = {}
@@ -292,7 +1592,161 @@ class Protocol(object):
         self._allow_new_session = {} # (host, port) -> [lock1, lock2, ...]
         self._favicon = default_favicon
         self._common_resources = kw.get('common_resources', {})
-
+        self._resource_cache = {} # {resource name: (data or file etag, etag, data, {encoding: compressed data})}
+        self._compression_threshold = kw.get('compression_threshold', None)
+        self._metrics = _Metrics()
+        self._serve_metrics = kw.get('serve_metrics', False)
+        self._profile_handlers = kw.get('profile_handlers', False)
+        self._handler_stats = {} # {handler: [calls, wall seconds, CPU seconds, max wall seconds]}
+        self._handler_stats_lock = _thread.allocate_lock()
+        self._slow_handler_threshold = kw.get('slow_handler_threshold', None)
+        self._running_handlers = {} # {thread id: [handler, start time, session, stack logged]}
+        self._watchdog_started = False
+        self._server_timing = kw.get('server_timing', False)
+        self._compression_level = kw.get('compression_level', 6)
+        self._max_request_size = kw.get('max_request_size', _http_max_body_size)
+        self._groups = {} # {name: Group}
+        self._groups_lock = _thread.allocate_lock()
+        self._engine = kw.get('engine', 'threads')
+        if not self._engine in ('threads', 'selectors'):
+            raise ValueError('invalid engine %r, expected "threads" or "selectors"' % (self._engine,))
+        self._event_loop = None
+        self._callbacks = _CallbackPool(kw.get('callback_workers', 0))
+        self._session_timeout = kw.get('session_timeout', None)
+        self._keepalive_interval = kw.get('keepalive_interval', None)
+        if self._keepalive_interval is None and self._session_timeout:
+            self._keepalive_interval = self._session_timeout / 3.0
+        self._on_session_closed = kw.get('on_session_closed', None)
+        self._reaper_started = False
+        self._listen_options = {} # {host_port: options of the first new_session}
+        self._worker = None # number of this worker process, see fork_workers()
+        self._bus = None # _WorkerBus to other worker processes
+        self._subscribers = {} # {channel: [func, ...]}
+        self._session_handlers = {} # {host_port: (handler, new_session options)}, see on_session()
+        self._first_page_wait = kw.get('first_page_wait', 0.1)
+
+    def metrics(self):
+        """Returns metrics as {name: {labels: value}}, where labels is
+        a tuple of (label_name, value) pairs. Histogram values are
+        dictionaries with keys "buckets" (list of (upper bound,
+        cumulative count)), "sum" and "count".
+
+        Example:
+            m = p.metrics()
+            print(m["httpgui_sessions_active"][()])
+            for labels, h in m.get("httpgui_event_seconds", {}).items():
+                print(dict(labels)["handler"], h["count"], h["sum"] / h["count"])
+        """
+        snapshot = self._metrics.snapshot()
+        sessions = list(self._sid2sess.values())
+        snapshot["httpgui_sessions_active"] = {(): len(sessions)}
+        snapshot["httpgui_long_polls_parked"] = {(): len([s for s in sessions if not s._delayed_response_conn is None])}
+        snapshot["httpgui_streams_open"] = {(): len([s for s in sessions if not s._stream_conn is None])}
+        snapshot["httpgui_browser_queue_entries"] = {(): sum([len(s._to_browser_queue) for s in sessions])}
+        callback_stats = self._callbacks.stats()
+        snapshot["httpgui_callbacks_queued"] = {(): callback_stats["queued"]}
+        snapshot["httpgui_callbacks_running"] = {(): callback_stats["running"]}
+        snapshot["httpgui_callback_wait_seconds_total"] = {(): callback_stats["wait_seconds_total"]}
+        return snapshot
+
+    def handler_stats(self):
+        """Returns {handler: {"calls", "wall_seconds", "cpu_seconds",
+        "max_wall_seconds"}} of event handlers run since the Protocol
+        was created with profile_handlers=True. handler is the Python
+        code of a python-on* attribute, "timer_tick" or "current()".
+
+        Example:
+            for handler, s in sorted(p.handler_stats().items(),
+                                     key=lambda item: -item[1]["wall_seconds"]):
+                print("%8.3f %8.3f %6d %s" % (s["wall_seconds"], s["cpu_seconds"],
+                                              s["calls"], handler))
+        """
+        self._handler_stats_lock.acquire()
+        try:
+            return dict([(handler, {"calls": calls, "wall_seconds": wall,
+                                    "cpu_seconds": cpu, "max_wall_seconds": max_wall})
+                         for handler, (calls, wall, cpu, max_wall) in self._handler_stats.items()])
+        finally: self._handler_stats_lock.release()
+
+    def _handler_started(self, session, handler, start):
+        if not self._slow_handler_threshold:
+            return
+        start_watchdog = False
+        self._handler_stats_lock.acquire()
+        try:
+            if not self._watchdog_started:
+                # started by the first handler rather than __init__,
+                # so that worker processes forked later get one
+                self._watchdog_started = True
+                start_watchdog = True
+            self._running_handlers[_thread.get_ident()] = [handler, start, session, False]
+        finally: self._handler_stats_lock.release()
+        if start_watchdog:
+            _thread.start_new_thread(self._slow_handler_watchdog, ())
+
+    def _handler_finished(self, session, handler, wall, cpu):
+        self._metrics.observe("httpgui_event_seconds", wall, (("handler", handler[:80]),))
+        if self._slow_handler_threshold:
+            self._handler_stats_lock.acquire()
+            try:
+                self._running_handlers.pop(_thread.get_ident(), None)
+            finally: self._handler_stats_lock.release()
+            if wall >= self._slow_handler_threshold:
+                log("slow event handler in session %s: %r took %.3f s, CPU %.3f s" % (
+                    session.name, handler, wall, cpu))
+        if self._profile_handlers:
+            self._handler_stats_lock.acquire()
+            try:
+                stats = self._handler_stats.get(handler, None)
+                if stats is None:
+                    self._handler_stats[handler] = [1, wall, cpu, wall]
+                else:
+                    stats[0] += 1
+                    stats[1] += wall
+                    stats[2] += cpu
+                    stats[3] = max(stats[3], wall)
+            finally: self._handler_stats_lock.release()
+
+    def _slow_handler_watchdog(self):
+        # Logs where event handlers that have been running longer
+        # than slow_handler_threshold are going, once per handler call.
+        while 1:
+            time.sleep(max(self._slow_handler_threshold / 4.0, 0.01))
+            now = time.time()
+            slow = []
+            self._handler_stats_lock.acquire()
+            try:
+                for thread_id, running in self._running_handlers.items():
+                    handler, start, session, stack_logged = running
+                    if not stack_logged and now - start >= self._slow_handler_threshold:
+                        running[3] = True
+                        slow.append((thread_id, handler, start, session))
+            finally: self._handler_stats_lock.release()
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for thread_id, handler, start, session in slow:
+                frame = frames.get(thread_id, None)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                log("slow event handler in session %s: %r running for %.3f s\n%s" % (
+                    session.name, handler, now - start, stack))
+
+    def _timing_headers(self, request):
+        """returns Server-Timing header of handlers run for request"""
+        if not self._server_timing or not request.timing:
+            return {}
+        return {"Server-Timing": _http_server_timing(request.timing)}
+
+    def metrics_text(self):
+        """Returns metrics in Prometheus text format"""
+        return _metrics_text(self.metrics())
+
+    def callback_stats(self):
+        """Returns statistics of running Python callbacks: number of
+        workers (0: not limited), threads, running and queued
+        callbacks, submitted and completed callbacks, total and
+        maximum seconds callbacks have waited for a worker."""
+        return self._callbacks.stats()
 
     def new_session(self, hostspec, **kw):
         """
@@ -307,6 +1761,48 @@ class Protocol(object):
             # no polling from server, all events are triggered by user
             new_session(":9999", timer_interval_ms=0, pending_server_events=0)
 
+            # server events and user events through a websocket
+            # instead of wait_server_event and event requests. Falls
+            # back to wait_server_event if websocket cannot be opened.
+            new_session(":9999", transport="websocket")
+
+            # server events as server-sent events (text/event-stream),
+            # user events as requests. Passes proxies that do not
+            # support websockets.
+            new_session(":9999", transport="sse")
+
+            # pages remember values sent by Page.update() and skip
+            # sending unchanged values, see Session.new_page(shadow=...)
+            new_session(":9999", shadow=True)
+
+            # keep at most 1000 updates or 1 MB of updates waiting
+            # for a browser that does not fetch them, for instance a
+            # hidden tab. When the limit is exceeded, queue_policy
+            # tells what to do:
+            #   "coalesce":    drop updates overwritten by later
+            #                  updates (default). If that is not
+            #                  enough, "rerender".
+            #   "drop_oldest": drop the oldest updates, keep page
+            #                  switches. If that is not enough,
+            #                  "rerender".
+            #   "rerender":    drop all updates and send the active
+            #                  page again. Values of a page with shadow
+            #                  state are sent again, too. If they do
+            #                  not fit in the limits, "disconnect".
+            #   "disconnect":  close the session.
+            # on_lagging(session) is called when the session falls
+            # behind, on_caught_up(session) when the browser has
+            # fetched the queue after that.
+            new_session(":9999", max_queue_entries=1000,
+                        max_queue_bytes=1000000, queue_policy="rerender",
+                        on_lagging=report_slow_client, on_caught_up=report_ok)
+
+            # the browser keeps the html of 20 recently shown pages
+            # (default 8), set_active() of a page whose html the
+            # browser has sends only the page settings. 0 sends the
+            # html every time.
+            new_session(":9999", page_cache_size=20)
+
             # custom favicon.ico
             new_session(":9999", favicon=_my_favicon_data)
 
@@ -315,11 +1811,8 @@ class Protocol(object):
             # globals().
             new_session(":9999", env=globals())
         """
-        try:
-            host, port_s = hostspec.split(":")
-            port = int(port_s)
-        except Exception as e:
-            raise Exception("invalid hostspec %r: %s" % (hostspec, e))
+        host, port = _hostspec_host_port(hostspec)
+        _check_session_options(kw)
         new_session_lock = self._new_session((host, port), **kw)
         new_session_lock.lock.acquire()
         if new_session_lock.sessname == "":
@@ -340,7 +1833,7 @@ class Protocol(object):
             # There is no server thread listening to the port.
             # Let's start one.
             self._allow_new_session[host_port] = [sl]
-            _thread.start_new_thread(self._http_server, (host_port, kw))
+            self._start_listening(host_port, kw)
         else:
             # Allow existing server thread, which listens to the given
             # port, accept a new session.
@@ -348,6 +1841,64 @@ class Protocol(object):
         self._allow_new_session_lock.release()
         return sl
 
+    def _start_listening(self, host_port, kw):
+        """start accepting connections to host_port, called with
+        _allow_new_session_lock"""
+        if not self._reaper_started and (self._session_timeout or self._keepalive_interval):
+            self._reaper_started = True
+            _thread.start_new_thread(self._reaper, ())
+        if self._engine == "selectors":
+            try:
+                if self._event_loop is None:
+                    self._event_loop = _EventLoop(self)
+                self._event_loop.listen(self._listening_socket(host_port), host_port, kw)
+                self._listen_options[host_port] = kw
+            except Exception as e:
+                log("cannot listen to %r: %s" % (host_port, e))
+                for sl in self._allow_new_session.pop(host_port):
+                    sl.lock.release()
+        else:
+            self._listen_options[host_port] = kw
+            _thread.start_new_thread(self._http_server, (host_port, kw))
+
+    def on_session(self, hostspec, handler, **kw):
+        """Calls handler(session) for every new session through
+        hostspec, instead of waiting for new_session() calls. Sessions
+        are accepted concurrently, each handler is run in a callback
+        thread (see callback_workers) before events of the session.
+        Keyword arguments are as in new_session(). Returns right
+        away, handler None stops calling the handler.
+
+        Example:
+            def show_dashboard(session):
+                session.new_page(dashboard_html(session.path()))
+            p.on_session(":8080", show_dashboard, transport="sse")
+        """
+        host_port = _hostspec_host_port(hostspec)
+        _check_session_options(kw)
+        if handler is None:
+            self._session_handlers.pop(host_port, None)
+            return
+        self._listening_socket(host_port) # raise if the port is not available
+        self._allow_new_session_lock.acquire()
+        try:
+            self._session_handlers[host_port] = (handler, kw)
+            if not host_port in self._allow_new_session:
+                self._allow_new_session[host_port] = []
+                self._start_listening(host_port, kw)
+        finally: self._allow_new_session_lock.release()
+
+    def serve(self, hostspec, handler, **kw):
+        """Calls handler(session) for every new session through
+        hostspec, see on_session(). Does not return.
+
+        Example:
+            httpgui.serve(":8080", show_dashboard)
+        """
+        self.on_session(hostspec, handler, **kw)
+        while 1:
+            time.sleep(3600)
+
     def _new_session_allowed(self, host_port):
         """returns 1 if new session through the port is allowed,
         otherwise 0"""
@@ -360,6 +1911,120 @@ class Protocol(object):
             self._allow_new_session_lock.release()
             return None
 
+    def fork_workers(self, count):
+        """Forks count - 1 worker processes that serve the same ports
+        as this process, so that Python callbacks can use count CPU
+        cores. Returns the number of the worker: 0 in this process,
+        1..count-1 in the forked ones. Call this before anything else,
+        then create sessions in every worker as usual.
+
+        The kernel distributes new connections between workers
+        (SO_REUSEPORT). A session lives in the worker that created
+        it. Session ids tell the worker, and a connection that carries
+        a request to a session of another worker is handed over to
+        that worker. Group.update() and publish() reach sessions in
+        all workers, other state is not shared. Workers exit when
+        worker 0 exits.
+
+        Example:
+            p = Protocol(engine="selectors")
+            p.fork_workers(os.cpu_count())
+            p.subscribe("chat", lambda message: show_message(message))
+            while 1:
+                session = p.new_session(":8080")
+                ...
+        """
+        if count < 1:
+            raise ValueError("invalid worker count %r" % (count,))
+        if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "recv_fds"):
+            raise ProtocolError("worker processes are not supported on this platform")
+        if self._allow_new_session or not self._bus is None:
+            raise ProtocolError("fork_workers() must be called before new_session()")
+        directory = tempfile.mkdtemp(prefix="httpgui-")
+        socks = []
+        for worker in range(count):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            s.bind(os.path.join(directory, "worker-%d" % (worker,)))
+            socks.append(s)
+        first_pid = os.getpid()
+        worker = 0
+        for child in range(1, count):
+            if os.fork() == 0:
+                worker = child
+                break
+        for other, s in enumerate(socks):
+            if other != worker:
+                s.close()
+        if worker == 0:
+            atexit.register(shutil.rmtree, directory, True)
+        self._worker = worker
+        self._bus = _WorkerBus(self, directory, worker, count, socks[worker],
+                               None if worker == 0 else first_pid)
+        return worker
+
+    def publish(self, channel, data):
+        """Calls functions subscribed to the channel with data in all
+        worker processes, see subscribe(). data is passed as JSON.
+
+        Example:
+            p.publish("room1", {"user": "alice", "message": "hello"})
+        """
+        text = json.dumps(data)
+        self._deliver(channel, json.loads(text))
+        if not self._bus is None:
+            self._bus.send_all({"publish": channel, "data": data})
+
+    def subscribe(self, channel, func):
+        """Calls func(data) when data is published to the channel in
+        any worker process. Functions are called in the order data was
+        published by a worker.
+
+        Example:
+            p.subscribe("room1", lambda data: p.group("room1").update(...))
+        """
+        self._subscribers.setdefault(channel, []).append(func)
+
+    def _deliver(self, channel, data):
+        for func in list(self._subscribers.get(channel, [])):
+            self._callbacks.submit(("publish", channel), func, data)
+
+    def _adopt_connection(self, sock, host_port, received):
+        """serve a connection handed over by another worker"""
+        options = self._listen_options.get(host_port, None)
+        if options is None:
+            log("worker %d does not serve %r, closing handed over connection" % (self._worker, host_port))
+            _close(sock)
+        elif self._engine == "selectors":
+            self._event_loop.adopt(sock, host_port, options, received)
+        else:
+            _thread.start_new_thread(self._serve_connection, (sock, host_port, options, received))
+
+    def group(self, name):
+        """Returns group of sessions with the name, creates a new
+        group if it does not exist.
+
+        Example:
+            # update the active page of every user in a room
+            p.group("room1").add(session)
+            p.group("room1").update({"users": "alice, bob"})
+        """
+        self._groups_lock.acquire()
+        try:
+            if not name in self._groups:
+                self._groups[name] = Group(self, name)
+            return self._groups[name]
+        finally: self._groups_lock.release()
+
+    def remove_group(self, name):
+        """Forget group of sessions with the name"""
+        self._groups_lock.acquire()
+        try:
+            group = self._groups.pop(name, None)
+        finally: self._groups_lock.release()
+        if not group is None:
+            for session in group.sessions():
+                group.remove(session)
+
     def close_session(self, session_id):
         if session_id in self._sid2conn:
             _close(self._sid2conn[session_id])
@@ -367,6 +2032,32 @@ class Protocol(object):
         if session_id in self._sid2sess:
             del self._sid2sess[session_id]
 
+    def _session_closed(self, session):
+        self._metrics.inc("httpgui_sessions_closed_total")
+        if not self._on_session_closed is None:
+            self._callbacks.submit(session, self._on_session_closed, session)
+
+    def _reaper(self):
+        # Closes sessions that have been idle longer than
+        # session_timeout and sends keepalives to browsers that
+        # wait for server events.
+        interval = min([t for t in (self._session_timeout, self._keepalive_interval) if t])
+        while 1:
+            time.sleep(max(interval / 4.0, 0.05))
+            now = time.time()
+            for sess in list(self._sid2sess.values()):
+                try:
+                    if (self._session_timeout and sess._stream_conn is None and
+                        now - sess._last_activity > self._session_timeout):
+                        log("closing idle session %s" % (sess.name,))
+                        sess.close()
+                    elif (self._keepalive_interval and
+                          now - sess._last_activity >= self._keepalive_interval and
+                          now - sess._last_keepalive >= self._keepalive_interval):
+                        sess._send_keepalive()
+                except Exception as e:
+                    log("reaper: session %s failed: %s" % (sess.name, e))
+
     def _http_server(self, host_port, options):
         # There is one http_server thread for each port that is
         # listened to. These threads start new thread for handling
@@ -374,6 +2065,7 @@ class Protocol(object):
         while 1:
             try:
                 conn = self._accept_tcp_connection(host_port)
+                self._metrics.inc("httpgui_connections_accepted_total")
             except:
                 for l in self._allow_new_session[host_port]:
                     l.lock.release()
@@ -390,100 +2082,312 @@ class Protocol(object):
             # Erroneous:   all other URLs
             _thread.start_new_thread(self._serve_connection, (conn, host_port, options))
 
-    def _serve_connection(self, conn, host_port, options):
+    def _serve_connection(self, conn, host_port, options, received=b""):
         # Connection handler. This handles http messages received
         # from the connection, establishes new session and
         # routes http messages to the correct sessions.
         log("serving connection to %s from %s" % (host_port, conn.getpeername()))
+        parser = _HttpParser(self._max_request_size)
+        parser.feed(received)
+        chunk = memoryview(bytearray(16384))
         while 1:
-            data = _http_read(conn)
-            if data == b"": # connection lost
+            try:
+                request = parser.read_request(conn, chunk)
+            except ProtocolError as e:
+                log("bad request from %s: %s" % (conn.getpeername(), e))
+                self._metrics.inc("httpgui_parse_errors_total", labels=(("kind", "http"),))
+                _http_send_status(conn, b"400 Bad Request", str(e))
                 break
-            data_first_line = data.split(b"\n", 1)[0]
-            if b"favicon.ico" in data_first_line:
-                if not "favicon" in options:
-                    _http_send_ok(conn, self._favicon)
-                else:
-                    _http_send_ok(conn, options['favicon'])
+            if request is None: # connection lost
+                break
+            sess = self._route_request(conn, request, host_port, options, parser)
+            if sess is True:
                 continue
-            if data_first_line.startswith(b"GET"):
-                fields = data_first_line.split(b" ")
-                if len(fields) == 3:
-                    resource = fields[1].decode("utf-8")
-                    handler = self._common_resources.get(resource, None)
-                    if isinstance(handler, dict):
-                        _http_send_ok(conn, handler["data"], handler)
-                        continue
-            session, object_id = self._check_session(data)
-            if not session: # this starts a new session
-                session_lock = self._new_session_allowed(host_port)
-                if not session_lock:
-                    _http_send_404(conn, "not taking new sessions right now")
-                    break
-                else: # register new session and release the lock
-                    sess = Session(self, env=options.get("env", None))
-                    # THINK: need for cryptic session id?
-                    identified_session = _session_id_new()
-                    browser_side_js_vars = {
-                        'session': str(identified_session, "utf-8"),
-                        'timer_interval_ms': 0, # default: no timer tick
-                        'pending_server_event': 1 # default: always wait for server messages
-                    }
-                    # enable changing timer_interval_ms and pending_server_event defaults
-                    browser_side_js_vars.update(options)
-                    sess._set_session_id(identified_session)
-                    sess._set_path(_path_parse(data))
-                    self._sid2sess[identified_session] = sess
-                    self._sid2conn[identified_session] = conn
-                    response = _html_basepage % (
-                        "",
-                        _browser_side_js % browser_side_js_vars)
-                    session_lock.sessname = str(sess)
-                    session_lock.sess = sess
-                    session_lock.lock.release()
-            elif session in self._sid2sess: # now the session is identified
-                # check connection validity in response because a
-                # browser can use the same tcp connection for
-                # different sessions.
-                sess = self._sid2sess[session]
-                response = sess._handle_http_data(data)
-                if response is None:
+            elif sess is False:
+                break
+            if _websocket_upgrade(request):
+                self._serve_websocket(conn, sess, request, parser.remaining(), chunk)
+                break
+            if _re_event_stream.match(request.path):
+                sess._accept_event_stream(conn)
+                self._stream_writer(conn, sess)
+                break
+            if _re_wait_server_event.match(request.path):
+                response = sess._handle_http_data(request)
+            else:
+                response = self._callbacks.call(sess, sess._handle_http_data, request)
+            if response is None:
+                break
+            elif response == "wait_server_event":
+                if not sess._delayed_response_conn is None:
+                    _http_send_ok(sess._delayed_response_conn, "")
+                    sess._delayed_response_conn = None
+                # do not send response to this event now. store the connection
+                # and send response to this connection when there
+                # is something to send
+                # this thread should send the response when ready
+                sess._delayed_response_conn = conn
+                while not sess._to_browser_queue and not sess._closed:
+                    sess._delayed_response_conn_lock.acquire()
+                if sess._closed:
                     break
-                elif response == "wait_server_event":
-                    if not sess._delayed_response_conn is None:
-                        _http_send_ok(sess._delayed_response_conn, "")
-                        sess._delayed_response_conn = None
-                    # do not send response to this event now. store the connection
-                    # and send response to this connection when there
-                    # is something to send
-                    # this thread should send the response when ready
-                    sess._delayed_response_conn = conn
-                    while not sess._to_browser_queue:
-                        sess._delayed_response_conn_lock.acquire()
-                    sess._to_browser_queue_lock.acquire()
+                sess._to_browser_queue_lock.acquire()
+                try:
+                    # no need to lock - this thread already has the lock
+                    response = sess._response_from_browser_queue(lock=False)
                     try:
-                        # no need to lock - this thread already has the lock
-                        response = sess._response_from_browser_queue(lock=False)
-                        try:
-                            _http_send_ok(sess._delayed_response_conn, response)
-                        except Exception as e:
-                            log("sending ok to a session failed: %s" % (e,))
-                            break
-                    finally:
-                        sess._delayed_response_conn = None
-                        sess._to_browser_queue_lock.release()
-                    continue
-            else: # session cannot be found in session library. strange
-                log("invalid session")
-                break
-            _http_send_ok(conn, response)
+                        _http_send_ok(sess._delayed_response_conn, response,
+                                      compression=self._compression(request))
+                    except Exception as e:
+                        log("sending ok to a session failed: %s" % (e,))
+                        break
+                finally:
+                    sess._delayed_response_conn = None
+                    sess._to_browser_queue_lock.release()
+                continue
+            _http_send_ok(conn, response, headers=self._timing_headers(request),
+                          compression=self._compression(request))
         _close(conn)
 
+    def _serve_websocket(self, conn, sess, request, received, chunk):
+        # Connection handler after switching to websocket protocol.
+        # Receives events from the browser in this thread, a writer
+        # thread sends the browser queue.
+        if not sess._accept_websocket(conn, request):
+            return
+        _thread.start_new_thread(self._stream_writer, (conn, sess))
+        parser = _WebSocketParser(self._max_request_size)
+        parser.feed(received)
+        try:
+            while 1:
+                try:
+                    message = parser.read_message(conn, chunk)
+                except ProtocolError as e:
+                    log("bad websocket message from %s: %s" % (conn.getpeername(), e))
+                    self._metrics.inc("httpgui_parse_errors_total", labels=(("kind", "websocket"),))
+                    break
+                if message is None:
+                    break
+                elif message[0] >= 0x8: # control frames are answered right away
+                    if not sess._handle_websocket_message(conn, *message):
+                        break
+                elif not self._callbacks.call(sess, sess._handle_websocket_message, conn, *message):
+                    break
+        finally:
+            sess._close_stream(conn)
+
+    def _stream_writer(self, conn, sess):
+        # Sends the browser queue of sess to conn whenever there is
+        # something to send, until the stream is closed.
+        while sess._stream_conn is conn:
+            if not sess._to_browser_queue:
+                sess._delayed_response_conn_lock.acquire()
+                continue
+            try:
+                sess._send_stream(conn)
+            except Exception as e:
+                log("sending to a stream failed: %s" % (e,))
+                sess._close_stream(conn)
+
+    def _route_request(self, conn, request, host_port, options, parser):
+        """responds to requests that are not handled by an existing
+        session: favicon, common resources and new sessions. Hands
+        the connection over to the worker process that owns the
+        session.
+
+        Returns True if the request has been responded, False if the
+        connection should be closed, or the session that should
+        handle the request."""
+        try:
+            resource = request.path.decode("utf-8")
+        except UnicodeDecodeError:
+            _http_send_status(conn, b"400 Bad Request", "request path is not UTF-8")
+            return False
+        if b"favicon.ico" in request.path:
+            if not "favicon" in options:
+                self._send_resource(conn, request, "favicon.ico",
+                                    {"Content-Type": "image/png", "data": self._favicon})
+            else:
+                self._send_resource(conn, request, "favicon.ico",
+                                    {"Content-Type": "image/x-icon", "data": options['favicon']})
+            return True
+        if request.method == b"GET":
+            if resource == "/.httpgui/metrics" and self._serve_metrics:
+                _http_send_ok(conn, self.metrics_text(),
+                              {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+                              compression=self._compression(request))
+                return True
+            if resource == _browser_side_js_path:
+                self._send_resource(conn, request, resource, _browser_side_js_resource)
+                return True
+            handler = self._common_resources.get(resource, None)
+            if isinstance(handler, dict):
+                self._send_resource(conn, request, resource, handler)
+                return True
+        session, object_id = self._check_session(request.path)
+        owner = _session_id_worker(session)
+        if not self._bus is None and not owner is None and owner != self._worker:
+            # the session lives in another worker process, and so
+            # will the rest of this connection
+            self._metrics.inc("httpgui_connections_handed_over_total")
+            self._bus.hand_over(owner, conn, host_port, _http_request_bytes(request) + parser.remaining())
+            return False
+        if not session: # this starts a new session
+            on_session = self._session_handlers.get(host_port, None)
+            if on_session is None:
+                session_lock = self._new_session_allowed(host_port)
+                if not session_lock:
+                    _http_send_404(conn, "not taking new sessions right now")
+                    return False
+            else:
+                session_lock = None
+                options = on_session[1]
+            # register new session and release the lock
+            self._metrics.inc("httpgui_sessions_created_total")
+            sess = Session(self, env=options.get("env", None),
+                           shadow=options.get("shadow", False),
+                           max_queue_entries=options.get("max_queue_entries", None),
+                           max_queue_bytes=options.get("max_queue_bytes", None),
+                           queue_policy=options.get("queue_policy", "coalesce"),
+                           on_lagging=options.get("on_lagging", None),
+                           on_caught_up=options.get("on_caught_up", None),
+                           page_cache_size=options.get("page_cache_size", 8))
+            # THINK: need for cryptic session id?
+            identified_session = _session_id_new(self._worker)
+            # timer_interval_ms, pending_server_event and transport
+            # defaults can be changed in options
+            browser_side_js_options = {
+                'session_id': str(identified_session, "utf-8"),
+                'timer_interval_ms': options.get('timer_interval_ms', 0), # default: no timer tick
+                'pending_server_event': options.get('pending_server_event', 1), # default: always wait for server messages
+                'transport': options.get('transport', 'poll') # default: wait_server_event long-polling
+            }
+            sess._set_session_id(identified_session)
+            sess._set_path(_path_parse(request))
+            sess._browser_side_js_options = browser_side_js_options
+            self._sid2sess[identified_session] = sess
+            self._sid2conn[identified_session] = conn
+            # respond when the first page is ready or first_page_wait
+            # has passed. The event loop serves other connections
+            # meanwhile, a thread of its own waits for the page.
+            sess._base_page = (conn, self._compression(request))
+            if self._first_page_wait and isinstance(conn, _LoopConnection):
+                conn._busy = True
+                self._event_loop.call_later(self._first_page_wait, sess._send_base_page)
+            if session_lock is None:
+                # the handler builds the first page while the browser
+                # loads the base page, events wait for the handler
+                self._callbacks.submit(sess, on_session[0], sess)
+            else:
+                session_lock.sessname = str(sess)
+                session_lock.sess = sess
+                session_lock.lock.release()
+            if not isinstance(conn, _LoopConnection):
+                if self._first_page_wait:
+                    sess._first_page.acquire(True, self._first_page_wait)
+                sess._send_base_page()
+            elif not self._first_page_wait:
+                sess._send_base_page()
+            return True
+        elif session in self._sid2sess: # now the session is identified
+            # check connection validity in response because a
+            # browser can use the same tcp connection for
+            # different sessions.
+            sess = self._sid2sess[session]
+            sess._last_activity = time.time()
+            if object_id == b"" and request.method == b"GET":
+                # reload button pressed on /session-id/, the
+                # browser expects to get all the page at once
+                sess._send_reloaded_page(conn, self._compression(request))
+                return True
+            return sess
+        else: # session cannot be found in session library. strange
+            log("invalid session")
+            return False
+
+    def _send_resource(self, conn, request, name, resource):
+        """responds with a common resource, or with 304 Not Modified
+        if the browser already has it"""
+        headers = {"Cache-Control": resource.get("Cache-Control", _default_cache_control)}
+        if "file" in resource:
+            # read from the disk on request, send with sendfile
+            headers["Content-Type"] = resource.get("Content-Type", None) or (
+                mimetypes.guess_type(resource["file"])[0] or "application/octet-stream")
+            try:
+                f = open(resource["file"], "rb")
+            except OSError as e:
+                log("cannot open resource %r: %s" % (name, e))
+                _http_send_404(conn, "resource not found")
+                return
+            try:
+                st = os.fstat(f.fileno())
+                etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+                headers["Last-Modified"] = email.utils.formatdate(st.st_mtime, usegmt=True)
+                if (st.st_size <= _compressed_file_max_size and
+                    not self._resource_compression(request, headers, st.st_size) is None):
+                    # send a compressed copy, read the file only when
+                    # it has changed
+                    cached = self._resource_cache.get(name, None)
+                    if cached is None or cached[0] != etag:
+                        cached = (etag, etag, f.read(), {})
+                        self._resource_cache[name] = cached
+                    self._send_resource_data(conn, request, headers, *cached[1:])
+                    return
+                headers["ETag"] = etag
+                if _http_not_modified(request, headers):
+                    _http_send_not_modified(conn, headers)
+                    return
+                conn.sendall(_http_ok_head(st.st_size, headers))
+                conn.sendfile(f, 0, st.st_size)
+            finally: f.close()
+            return
+        data = resource["data"]
+        cached = self._resource_cache.get(name, None)
+        if cached is None or not cached[0] is data:
+            cached = (data, '"%s"' % (hashlib.sha1(data).hexdigest()[:20],), data, {})
+            self._resource_cache[name] = cached
+        headers["Content-Type"] = resource.get("Content-Type", b"text/html; charset=utf-8")
+        self._send_resource_data(conn, request, headers, *cached[1:])
+
+    def _send_resource_data(self, conn, request, headers, etag, data, compressed):
+        """responds with data, or its copy in compressed {encoding:
+        data} if the request accepts it"""
+        compression = self._resource_compression(request, headers, len(data))
+        if not compression is None:
+            encoding, level, threshold = compression
+            if not encoding in compressed:
+                compressed[encoding] = _http_compress(data, encoding, level)
+            data = compressed[encoding]
+            headers["Content-Encoding"] = encoding
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        headers["ETag"] = etag
+        if _http_not_modified(request, headers):
+            _http_send_not_modified(conn, headers)
+        else:
+            conn.sendall(_http_ok_head(len(data), headers) + data)
+
+    def _resource_compression(self, request, headers, size):
+        """returns compression of a resource, see _compression"""
+        if self._compression_threshold is None or not _http_compressible(headers["Content-Type"]):
+            return None
+        headers["Vary"] = "Accept-Encoding"
+        compression = self._compression(request)
+        if compression[0] is None or size < compression[2]:
+            return None
+        return compression
+
+    def _compression(self, request):
+        """returns (encoding, level, threshold) for compressing a
+        response to request, or None if compression is disabled.
+        encoding is None if the request does not accept gzip or
+        deflate."""
+        if self._compression_threshold is None:
+            return None
+        return (_http_accepted_encoding(request), self._compression_level, self._compression_threshold)
+
     def _check_session(self, s):
         """returns id of an session (a non-empty string) or
-        an empty string if data seems to start a new session"""
-        s = s.split(b'\n', 1)[0] # it's on the first row
-        s = s.split(b' ')[1] # between two spaces: GET<space>addr<space>HTTP/1.1
+        an empty string if request path s seems to start a new session"""
         session_id = b""
         object_id = b""
         try:
@@ -501,6 +2405,13 @@ class Protocol(object):
         """
         Returns an open socket object.
         """
+        conn, src = self._listening_socket(host_port).accept()
+        return conn
+
+    def _listening_socket(self, host_port):
+        """
+        Returns a socket bound to host_port.
+        """
         if host_port in self._sockets:
             s = self._sockets[host_port]
         else:
@@ -510,11 +2421,14 @@ class Protocol(object):
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             except:
                 pass
+            if not self._bus is None:
+                # worker processes listen to the same port, the
+                # kernel distributes connections between them
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             s.bind(host_port)
-            s.listen(1)
+            s.listen(socket.SOMAXCONN)
             self._sockets[host_port] = s
-        conn, src = s.accept()
-        return conn
+        return s
 
 class Session(object):
     """
@@ -529,13 +2443,37 @@ class Session(object):
         self._protocol = protocol
         self._pages = {}
         self._to_browser_queue = []
+        self._to_browser_queue_bytes = 0
         self._to_browser_queue_lock = _thread.allocate_lock()
+        self._max_queue_entries = kw.get("max_queue_entries", None)
+        self._max_queue_bytes = kw.get("max_queue_bytes", None)
+        self._queue_policy = kw.get("queue_policy", "coalesce")
+        self._on_lagging = kw.get("on_lagging", None)
+        self._on_caught_up = kw.get("on_caught_up", None)
+        self._lagging = False # browser queue has exceeded its limits
+        self._page_cache_size = kw.get("page_cache_size", 8)
+        self._browser_pages = collections.OrderedDict() # {digest: None} html the browser has cached, least recently shown first
+        self._browser_pages_forgotten = False # the browser has html that is not in _browser_pages
+        self._shadow = kw.get("shadow", False) # default for new pages
         self._active_page = Page(self, "") # a dummy page
         self._delayed_response_conn = None
+        self._delayed_response_compression = None
         self._delayed_response_conn_lock = _thread.allocate_lock()
         self._delayed_response_conn_lock.acquire()
+        self._stream_conn = None # websocket or event stream that carries browser queue
+        self._stream_frame = None # function that makes a frame of a response
+        self._stream_send_lock = _thread.allocate_lock()
         self._env = env
         self._path = None
+        self._groups = set() # groups where this session belongs to
+        self._last_activity = time.time() # last request from the browser
+        self._last_keepalive = 0.0
+        self._closed = False
+        self._profiler = None # cProfile.Profile of event handlers
+        self._browser_side_js_options = {}
+        self._base_page = None # (conn, compression) of a new session waiting for the first page
+        self._first_page = _thread.allocate_lock() # released when the first page is active
+        self._first_page.acquire()
 
     def _set_session_id(self, session_id):
         self._session_id = session_id
@@ -555,7 +2493,8 @@ class Session(object):
         """Creates new page on browser.
 
         Parameters:
-          html (string):  html content for the page
+          html (string or PageTemplate):
+                          html content for the page
 
           additional parameters (optional):
             function:             makes python function callable from events.
@@ -580,10 +2519,19 @@ class Session(object):
                                   Sets timer_interval_ms=0,
                                   pending_server_event=0, and
                                   session_id="".
+            shadow (bool)
+                                  remember values sent with update() and
+                                  do not send a value again if it has not
+                                  changed. Not suitable for values that
+                                  users edit, like input element values,
+                                  unless the page is told to forget them
+                                  with invalidate_shadow().
+                                  Overrides Session parameter.
         """
         new_page = Page(self, html, **options)
         self._pages[str(new_page)] = new_page
-        self.set_active(str(new_page))
+        # the env must be ready before the browser can send events
+        # from the page
         funcname_func = {}
         if self._env:
             new_page.update_env(self._env)
@@ -596,61 +2544,468 @@ class Session(object):
                 raise ValueError('invalid parameter %r, expected function or eval env dictionary' % (func_or_env,))
         if funcname_func:
             new_page.update_env(funcname_func)
+        self.set_active(str(new_page))
         return new_page
 
     def set_active(self, page_id):
         """
-        Activates page_id. The browser should be evaluating (eval)
+        Activates page_id. The browser should be applying
         responses.
         """
         if not page_id in self._pages:
             raise Exception("Page %s not found in %s" %
                             (page_id, repr(self)))
         self._active_page = self._pages[page_id]
-        # TODO: add JS code that changes pending_server_event and timer_interval_ms
-        js_to_browser = []
-        if not self._active_page._pending_server_event is None:
-            js_to_browser.append("pending_server_event = %s;" % (self._active_page._pending_server_event,))
-        if not self._active_page._timer_interval_ms is None:
-            js_to_browser.append("timer_interval_ms = %s;" % (self._active_page._timer_interval_ms,))
-            if self._active_page._timer_interval_ms > 0:
-                js_to_browser.append("setTimeout(timer_tick, timer_interval_ms);")
-        if self._active_page._static:
-            js_to_browser.extend([
-                "pending_server_event = 0;",
-                "timer_interval_ms = 0;",
-                'session_id = "";'])
-        js_to_browser.append("document.getElementById('rootdiv').innerHTML=%r;" %
-            (self._active_page.tokenized_html(),))
-        self._add_to_browser_queue("".join(js_to_browser))
+        # the browser gets original html, previous updates are gone
+        self._active_page.invalidate_shadow()
+        # the page cache bookkeeping needs the browser queue lock
+        self._add_to_browser_queue(("page", None, self._active_page._activation_ops))
+        if self._first_page.locked():
+            try:
+                self._first_page.release()
+            except RuntimeError:
+                pass # released by another thread
+            base_page = self._base_page
+            if not base_page is None and isinstance(base_page[0], _LoopConnection):
+                self._send_base_page()
+
+    def _send_base_page(self):
+        """respond to the request that started the session with the
+        base page. If the first page is ready, it is in the base page
+        and the browser queue is evaluated when the page is loaded."""
+        self._to_browser_queue_lock.acquire()
+        try:
+            if self._base_page is None:
+                return # already sent
+            (conn, compression), self._base_page = self._base_page, None
+            html = ""
+            options = dict(self._browser_side_js_options)
+            if self._pages:
+                html, options["initial"] = self._inline_browser_queue()
+        finally: self._to_browser_queue_lock.release()
+        self._send_basepage(conn, html, options, compression)
+        if isinstance(conn, _LoopConnection):
+            conn._busy = False
+            conn._loop.wake(conn)
+
+    def _send_reloaded_page(self, conn, compression):
+        """respond with the base page and the active page as it
+        should be now, forget updates to the previous browser page"""
+        self._to_browser_queue_lock.acquire()
+        try:
+            entries = self._active_page._rerender_entries([])[1:]
+            code = [self._active_page._activation_ops(html=False)]
+            self._set_browser_queue([])
+            self._caught_up()
+        finally: self._to_browser_queue_lock.release()
+        options = dict(self._browser_side_js_options)
+        options["initial"] = _browser_ops(code + [code for kind, key, code in entries])
+        self._send_basepage(conn, self._active_page.tokenized_html(), options, compression)
+        self._protocol._callbacks.submit(self, self._active_page.browser_reload)
+
+    def _show_page_ops(self, page):
+        """returns operations that show the html of page. The html
+        is sent only if the browser does not have it in its page
+        cache. Pages with the same html share the cache entry.
+        Called with _to_browser_queue_lock acquired."""
+        html = page.tokenized_html()
+        if self._page_cache_size <= 0 or page._static:
+            return _browser_op("page", html)
+        ops = []
+        if self._browser_pages_forgotten:
+            self._browser_pages_forgotten = False
+            ops.append(_browser_op("uncache"))
+        digest = page._template._digest
+        if digest in self._browser_pages:
+            self._browser_pages.move_to_end(digest)
+            ops.append(_browser_op("show", digest))
+        else:
+            self._browser_pages[digest] = None
+            evicted = []
+            while len(self._browser_pages) > self._page_cache_size:
+                evicted.append(self._browser_pages.popitem(last=False)[0])
+            ops.append(_browser_op("show", digest, html, evicted))
+        return ",".join(ops)
+
+    def _cache_shown_page_ops(self, page):
+        """returns operations that put html of page, already shown
+        by a new base page, to the empty page cache of the browser.
+        Called with _to_browser_queue_lock acquired."""
+        self._browser_pages.clear()
+        self._browser_pages_forgotten = False
+        if self._page_cache_size <= 0 or page._static:
+            return ""
+        self._browser_pages[page._template._digest] = None
+        return _browser_op("cache", page._template._digest)
+
+    def _forget_browser_pages(self):
+        """the browser may miss html sent to its page cache, send
+        html again and clear the cache on the next page switch.
+        Called with _to_browser_queue_lock acquired."""
+        if self._browser_pages:
+            self._browser_pages.clear()
+            self._browser_pages_forgotten = True
+
+    def _send_basepage(self, conn, html, options, compression):
+        _http_send_ok(conn, _html_basepage % (
+            bytes(html, "utf-8"),
+            bytes(json.dumps(options).replace("</", "<\\/"), "utf-8")), compression=compression)
+
+    def _inline_browser_queue(self):
+        """returns html of the active page and JSON operations of
+        the browser queue that follow it. Called with the browser queue
+        lock, empties the queue."""
+        entries = _coalesced_browser_queue_entries(self._to_browser_queue)
+        page_indexes = [i for i, entry in enumerate(entries) if entry[0] == "page"]
+        last_page = page_indexes[-1] if page_indexes else -1
+        # updates to elements of previous pages are gone anyway
+        code = [entry[2] for entry in entries[:max(last_page, 0)]
+                if entry[0] == "js" or entry[0] == "set" and entry[1][0] is None]
+        code.append(self._active_page._activation_ops(html=False))
+        code.extend([entry[2] for entry in entries[last_page + 1:]])
+        if self._to_browser_queue:
+            self._protocol._metrics.observe("httpgui_flush_entries", len(self._to_browser_queue))
+        self._set_browser_queue([])
+        self._caught_up()
+        return self._active_page.tokenized_html(), _browser_ops(code)
 
     def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for group in list(self._groups):
+            group.remove(self)
         self._protocol.close_session(self._session_id)
         if self._delayed_response_conn:
             c, self._delayed_response_conn = self._delayed_response_conn, None
             _close(c)
+        if self._stream_conn:
+            c, self._stream_conn = self._stream_conn, None
+            _close(c)
+        if self._delayed_response_conn_lock.locked():
+            # let threads waiting for the browser queue quit
+            self._delayed_response_conn_lock.release()
+        self._protocol._session_closed(self)
+
+    def start_profiling(self):
+        """Profiles event handlers of this session with cProfile until
+        stop_profiling() is called."""
+        if self._profiler is None:
+            self._profiler = cProfile.Profile()
+
+    def stop_profiling(self):
+        """Stops profiling event handlers of this session. Returns
+        pstats.Stats of handlers run since start_profiling(), or None
+        if nothing was profiled.
+
+        Example:
+            session.stop_profiling().sort_stats("cumulative").print_stats(20)
+        """
+        profiler, self._profiler = self._profiler, None
+        if profiler is None:
+            return None
+        try:
+            return pstats.Stats(profiler)
+        except TypeError: # no handlers were run
+            return None
+
+    def _call_handler(self, handler, timing, func, *args):
+        """returns func(*args). handler names the event handler in
+        metrics, stats and logs. (handler, wall seconds, CPU seconds)
+        is appended to timing, unless it is None."""
+        protocol = self._protocol
+        profiler = self._profiler
+        if not profiler is None:
+            try:
+                profiler.enable()
+            except ValueError: # another profiler is active
+                profiler = None
+        start, cpu_start = time.time(), time.thread_time()
+        protocol._handler_started(self, handler, start)
+        try:
+            return func(*args)
+        finally:
+            wall, cpu = time.time() - start, time.thread_time() - cpu_start
+            if not profiler is None:
+                profiler.disable()
+            protocol._handler_finished(self, handler, wall, cpu)
+            if not timing is None:
+                timing.append((handler, wall, cpu))
+
+    def _send_keepalive(self):
+        """keep an idle browser connection open: empty response to
+        wait_server_event, a comment on an event stream or a ping on
+        a websocket"""
+        self._last_keepalive = time.time()
+        conn = self._stream_conn
+        if not conn is None:
+            if self._stream_frame is _sse_frame:
+                frame = b": keepalive\n\n"
+            else:
+                frame = _websocket_frame(b"", 0x9)
+            try:
+                self._send_stream_frame(conn, frame)
+            except Exception as e:
+                log("keepalive to a stream failed: %s" % (e,))
+                self._close_stream(conn)
+        elif not self._delayed_response_conn is None and not self._to_browser_queue:
+            self._add_to_browser_queue(("js", None, "")) # empty response
 
     def _response_from_browser_queue(self, lock=True):
         if lock:
             self._to_browser_queue_lock.acquire()
-        response = ';\n\n'.join(self._to_browser_queue)
+        entries = len(self._to_browser_queue)
+        response = _coalesced_browser_queue(self._to_browser_queue)
         self._to_browser_queue = []
+        self._to_browser_queue_bytes = 0
+        self._caught_up()
         if lock:
             self._to_browser_queue_lock.release()
+        if entries:
+            self._protocol._metrics.observe("httpgui_flush_entries", entries)
+            self._protocol._metrics.observe("httpgui_flush_bytes", len(response))
         return response
 
-    def _add_to_browser_queue(self, js):
+    def _add_to_browser_queue(self, *updates):
+        """add (kind, key, code) updates to the browser queue, see
+        _coalesced_browser_queue. A string is raw JavaScript. A
+        callable code is called with the browser queue lock acquired."""
+        if self._closed:
+            return # nobody will fetch the updates
+        disconnect = False
         self._to_browser_queue_lock.acquire()
         try:
-            self._to_browser_queue.append(js)
+            for update in updates:
+                if isinstance(update, str):
+                    update = ("js", None, _browser_op("js", update))
+                elif callable(update[2]):
+                    update = update[:2] + (update[2](),)
+                self._to_browser_queue.append(update)
+                self._to_browser_queue_bytes += len(update[2])
+            if self._browser_queue_full():
+                disconnect = self._limit_browser_queue()
         finally: self._to_browser_queue_lock.release()
-        if self._delayed_response_conn_lock.locked():
-            # let the thread that received wait_server_event
-            # continue immediately and send the browser queue
+        if disconnect:
+            log("closing session %s, browser queue is full" % (self.name,))
+            self.close()
+            return
+        self._wake_browser_queue_sender()
+
+    def _browser_queue_full(self):
+        return ((self._max_queue_entries and len(self._to_browser_queue) > self._max_queue_entries) or
+                (self._max_queue_bytes and self._to_browser_queue_bytes > self._max_queue_bytes))
+
+    def _set_browser_queue(self, entries):
+        self._to_browser_queue = entries
+        self._to_browser_queue_bytes = sum([len(code) for kind, key, code in entries])
+
+    def _caught_up(self):
+        """the browser has got everything in the queue. Called with
+        _to_browser_queue_lock acquired."""
+        if self._lagging:
+            self._lagging = False
+            if not self._on_caught_up is None:
+                self._protocol._callbacks.submit(self, self._on_caught_up, self)
+
+    def _limit_browser_queue(self):
+        """apply queue_policy to the browser queue that exceeds its
+        limits. Called with _to_browser_queue_lock acquired. Returns
+        True if the session should be closed."""
+        if not self._lagging:
+            self._lagging = True
+            if not self._on_lagging is None:
+                self._protocol._callbacks.submit(self, self._on_lagging, self)
+        policy = self._queue_policy
+        if policy == "disconnect":
+            return True
+        if policy == "coalesce":
+            self._set_browser_queue(_coalesced_browser_queue_entries(self._to_browser_queue))
+            if not self._browser_queue_full():
+                return False
+            policy = "rerender"
+        if policy == "drop_oldest":
+            queue = self._to_browser_queue
+            shadow = self._active_page._shadow
+            index = 0
+            while index < len(queue) - 1 and self._browser_queue_full():
+                kind, key, code = queue[index]
+                if kind == "page":
+                    # the browser must be on the same page as the
+                    # server, or tokens of events mean other handlers
+                    index += 1
+                    continue
+                del queue[index]
+                self._to_browser_queue_bytes -= len(code)
+                if kind == "set" and not shadow is None:
+                    shadow.pop(key, None) # the browser will not get it
+            if not self._browser_queue_full():
+                return False
+            policy = "rerender"
+        if policy == "rerender":
+            self._set_browser_queue(self._active_page._rerender_entries(self._to_browser_queue))
+            if self._browser_queue_full():
+                # the page and its shadow values alone exceed the
+                # limits, rerendering again would not help
+                log("session %s: the page does not fit in the browser queue limits" % (self.name,))
+                return True
+        return False
+
+    def _wake_browser_queue_sender(self):
+        if isinstance(self._stream_conn, _LoopConnection):
+            # event loop engine: nobody is waiting in a thread,
+            # send to the stream right away
+            self._send_stream(self._stream_conn)
+        elif isinstance(self._delayed_response_conn, _LoopConnection):
+            # event loop engine: respond to wait_server_event right away
+            self._send_delayed_response()
+        elif self._delayed_response_conn_lock.locked():
+            # let the thread that received wait_server_event or
+            # writes to a stream continue immediately and send the
+            # browser queue
             self._delayed_response_conn_lock.release()
 
-    def _handle_http_data(self, data):
-        def check_event(data):
+    def _park_delayed_response(self, conn, compression=None):
+        """respond to wait_server_event received from conn when there
+        is something to send. Used by the event loop engine."""
+        self._to_browser_queue_lock.acquire()
+        try:
+            previous_conn = self._delayed_response_conn
+            self._delayed_response_conn = conn
+            self._delayed_response_compression = compression
+        finally: self._to_browser_queue_lock.release()
+        conn.parked_session = self
+        if not previous_conn is None and not previous_conn is conn:
+            previous_conn.parked_session = None
+            _http_send_ok(previous_conn, "")
+        self._send_delayed_response()
+
+    def _unpark_delayed_response(self, conn):
+        """forget conn waiting for a server event, connection lost"""
+        self._to_browser_queue_lock.acquire()
+        try:
+            if self._delayed_response_conn is conn:
+                self._delayed_response_conn = None
+        finally: self._to_browser_queue_lock.release()
+
+    def _send_delayed_response(self):
+        self._to_browser_queue_lock.acquire()
+        try:
+            conn = self._delayed_response_conn
+            if conn is None or not self._to_browser_queue:
+                return
+            response = self._response_from_browser_queue(lock=False)
+            compression = self._delayed_response_compression
+            self._delayed_response_conn = None
+        finally: self._to_browser_queue_lock.release()
+        conn.parked_session = None
+        _http_send_ok(conn, response, compression=compression)
+
+    def _accept_websocket(self, conn, request):
+        """switch conn to websocket protocol for sending the browser
+        queue and receiving events. Returns False on failure."""
+        key = request.headers.get(b"sec-websocket-key", b"")
+        if not key or request.headers.get(b"sec-websocket-version", b"") != b"13":
+            _http_send_status(conn, b"400 Bad Request", "unsupported websocket request")
+            return False
+        accept = base64.b64encode(hashlib.sha1(key + _websocket_guid).digest())
+        conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\n"
+                     b"Server: Hot Penguin\r\n"
+                     b"Upgrade: websocket\r\n"
+                     b"Connection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: %b\r\n\r\n" % (accept,))
+        self._open_stream(conn, _websocket_frame)
+        return True
+
+    def _accept_event_stream(self, conn):
+        """respond with an event stream that carries the browser
+        queue as server-sent events"""
+        conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                     b"Server: Hot Penguin\r\n"
+                     b"Content-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\n"
+                     b"X-Accel-Buffering: no\r\n"
+                     b"Connection: Keep-Alive\r\n\r\n")
+        self._open_stream(conn, _sse_frame)
+
+    def _handle_websocket_message(self, conn, opcode, payload):
+        """returns False if the websocket should be closed"""
+        self._last_activity = time.time()
+        if opcode == 0x8: # close
+            self._send_stream_frame(conn, _websocket_frame(payload[:2], 0x8))
+            return False
+        elif opcode == 0x9: # ping
+            self._send_stream_frame(conn, _websocket_frame(payload, 0xa))
+            return True
+        elif opcode == 0xa: # pong
+            return True
+        # event: "URL\nCONTENT", where URL is as in event requests
+        method_call_raw, _, body = payload.partition(b"\n")
+        if self._handle_event(method_call_raw, body, respond=False) is None:
+            return False
+        self._wake_browser_queue_sender()
+        return True
+
+    def _open_stream(self, conn, frame):
+        """send browser queue to conn from now on, frame(response)
+        returns bytes to be sent"""
+        self._to_browser_queue_lock.acquire()
+        try:
+            previous_conn = self._stream_conn
+            self._stream_conn, self._stream_frame = conn, frame
+        finally: self._to_browser_queue_lock.release()
+        if not previous_conn is None:
+            _close(previous_conn)
+        self._wake_browser_queue_sender()
+
+    def _close_stream(self, conn):
+        self._to_browser_queue_lock.acquire()
+        try:
+            if self._stream_conn is conn:
+                self._stream_conn = None
+        finally: self._to_browser_queue_lock.release()
+        if self._delayed_response_conn_lock.locked():
+            self._delayed_response_conn_lock.release() # let stream writer quit
+
+    def _send_stream(self, conn):
+        """send the browser queue to the stream conn. Frames are sent
+        in the order they are taken from the queue."""
+        self._stream_send_lock.acquire()
+        try:
+            self._to_browser_queue_lock.acquire()
+            try:
+                if not self._stream_conn is conn or not self._to_browser_queue:
+                    return
+                frame = self._stream_frame(self._response_from_browser_queue(lock=False))
+            finally: self._to_browser_queue_lock.release()
+            conn.sendall(frame)
+        finally: self._stream_send_lock.release()
+
+    def _send_stream_frame(self, conn, frame):
+        self._stream_send_lock.acquire()
+        try:
+            conn.sendall(frame)
+        finally: self._stream_send_lock.release()
+
+    def _handle_http_data(self, request):
+        try:
+            # FIX: repeating code (check_session) --- implement
+            # URL parsing in one place only.
+            path = request.path
+            first_slash = path.index(b"/")
+            second_slash = path.index(b"/", first_slash + 1)
+            method_call_raw = urllib.parse.unquote_to_bytes(path[second_slash+1:])
+        except ValueError as e:
+            log("Cannot parse event from request %r: %s" % (request.path, e))
+            self._protocol._metrics.inc("httpgui_parse_errors_total", labels=(("kind", "event"),))
+            return None
+        return self._handle_event(method_call_raw, request.body, timing=request.timing)
+
+    def _handle_event(self, method_call_raw, body, respond=True, timing=None):
+        """handle event or wait_server_event from the browser. Returns
+        the browser queue if respond is True, otherwise 1, or
+        "wait_server_event", or None if the event is invalid. Run
+        times of handlers are appended to timing list."""
+        def check_event(method_call_raw, body):
             """
             If something must be responded to the browser right away,
             it is returned as a return value. This should be done only
@@ -661,62 +3016,59 @@ class Session(object):
             # parse event
             method_name = b""
             method_call = None
+            method_code = None
             try:
-                # FIX: repeating code (check_session) --- implement
-                # URL parsing in one place only.
-                postline = data[:data.index(b"\n")].strip()
-                first_slash = postline.index(b"/")
-                second_slash = postline.index(b"/", first_slash + 1)
-                session_id = postline[first_slash + 1:second_slash]
-                method_call_raw = urllib.parse.unquote_to_bytes(postline[second_slash+1:postline.rfind(b" ")])
                 method_name = method_call_raw[:method_call_raw.find(b"(")]
                 if method_name == b"wait_server_event":
                     return "wait_server_event"
                 elif method_name == b"timer_tick":
-                    if not _re_timer_tick.match(method_call_raw):
+                    timer_tick_match = _re_timer_tick.fullmatch(method_call_raw)
+                    if not timer_tick_match:
                         raise ValueError('illegal timer_tick call %r' % (method_call_raw[:42].decode("utf-8"),))
                     else:
                         method_call = method_call_raw # passed security check: _re_timer_tick match
+                        tick_count = int(timer_tick_match.group(1))
                 elif not method_name in b"TC":
                     raise ValueError('invalid method name in %r' % (method_call_raw[:42].decode("utf-8"),))
-                elif not method_call_raw in self._active_page._token2python:
-                    raise ValueError('token %r not found in page' % (method_call_raw[:42].decode("utf-8"),))
                 else:
-                    method_call = self._active_page._token2python[method_call_raw]
-                ctx_vars = json.loads(data[data.index(b'\r\n\r\n')+4:].strip())
+                    method_call = self._active_page._token_python(method_call_raw)
+                    if method_call is None:
+                        raise ValueError('token %r not found in page' % (method_call_raw[:42].decode("utf-8"),))
+                    method_code = self._active_page._token_code(method_call_raw)
+                ctx_vars = json.loads(body)
             except Exception as e:
-                log("Cannot parse event from data %r: %s" % (data.decode("utf-8"), e))
+                log("Cannot parse event %r %r: %s" % (method_call_raw[:42], body[:200], e))
+                self._protocol._metrics.inc("httpgui_parse_errors_total", labels=(("kind", "event"),))
                 return None
-            method_env = {}
-            method_env.update(self._active_page._env) # define callback functions in env
+            metrics = self._protocol._metrics
+            # page env is used as globals as is, ctx is the argument of
+            # the compiled handler: no per-event copy of the env
+            method_env = self._active_page._env
             ctx = Context(self, self._active_page)
             for var in ctx_vars:
                 setattr(ctx, var, ctx_vars[var])
-            method_env['ctx'] = ctx
-
-            if method_name == b"":
-                # matching page_id but request has no
-                # parameters. Assume that browser reload has been pressed.
-                # Response must be urgent, because the browser expects
-                # to get all the page at once.
-                _thread.start_new_thread(self._active_page.browser_reload, ())
-                # TODO: send the base page and the html of the current form
-                # *in the same package* to save time
-                return None
-            elif method_name == b"timer_tick" and not "timer_tick" in method_env:
-                # skip calling timer_tick if there is no callback for it
-                return 1
+
+            if method_name == b"timer_tick":
+                metrics.inc("httpgui_timer_ticks_total")
+                if not "timer_tick" in method_env:
+                    # skip calling timer_tick if there is no callback for it
+                    return 1
+                try:
+                    self._call_handler("timer_tick", timing, method_env["timer_tick"], ctx, tick_count)
+                    return 1
+                except Exception as e:
+                    log("http_server: exception when calling %r:\n    %s\n%s" % (method_call, e, traceback.format_exc()))
             elif method_name == b"C":
                 # call current() callback
                 try:
-                    method_call(ctx_vars['current_dict'])
+                    self._call_handler("current()", timing, method_call, ctx_vars['current_dict'])
                 except Exception as e:
                     log("http_server: exception when calling current() callback:\n    %s\n%s" % (e, traceback.format_exc()))
                 return 1
             else:
-                # evaluate untokenized method or validated timer_tick expression
+                # evaluate python code of the token, compiled when tokenized
                 try:
-                    eval(method_call, method_env, method_env)
+                    self._call_handler(method_call, timing, types.FunctionType(method_code, method_env), ctx)
                     return 1
                 except Exception as e:
                     log("http_server: exception when evaluating %r:\n    %s\n%s" % (method_call, e, traceback.format_exc()))
@@ -727,62 +3079,168 @@ class Session(object):
         # may take time should be done in a separate thread.
 
         # Check if this message is an event
-        parsed_event = check_event(data)
+        parsed_event = check_event(method_call_raw, body)
 
         if not parsed_event:
             log("http_server: could not handle message, closing")
             return None
         if parsed_event == "wait_server_event":
             return "wait_server_event"
+        if not respond:
+            return 1
         return self._response_from_browser_queue()
 
+def _compile_event_handler(python_code):
+    """returns code object of python-on* attribute value. Raises
+    SyntaxError already when the page is created.
+
+    The code is compiled as body of "lambda ctx: ..." so that it can
+    be run with the page env as globals and ctx as the only local,
+    without copying the env for every event."""
+    filename = "<python-on* %s>" % (python_code[:42],)
+    compile(python_code, filename, "eval") # report syntax errors as written
+    lambda_code = compile("lambda ctx: (%s\n)" % (python_code,), filename, "eval")
+    for const in lambda_code.co_consts:
+        if isinstance(const, types.CodeType):
+            return const
+    raise SyntaxError('invalid python-on* code %r' % (python_code[:42],))
+
+def _tokenize_html(html, token):
+    """returns html where python-on* attributes are replaced by
+    send_event() calls. token(python_code) returns the token that
+    identifies python_code in events."""
+    tokenized_html = []
+    done = 0 # html[:done] has been tokenized
+    for python_event_match in _re_python_attr.finditer(html):
+        tokenized_html.append(html[done:python_event_match.start()])
+        python_code = python_event_match.groupdict()['python']
+        js_event = python_event_match.groupdict()['js_event']
+        if not python_event_match.groupdict()['event_attrs'] is None:
+            event_attrs = str([a.strip() for a in python_event_match.groupdict()['event_attrs'].split(",")])
+        else:
+            event_attrs = "undefined"
+        tokenized_html.append(''' %s="send_event('%s', event, this, %s)"''' % (js_event, token(python_code).decode("utf-8"), event_attrs))
+        done = python_event_match.end()
+    tokenized_html.append(html[done:])
+    return "".join(tokenized_html)
+
+class PageTemplate(object):
+    """
+    Tokenized page html that is shared by pages of many sessions.
+
+    Example:
+        chat_room = httpgui.PageTemplate(
+            '<input id="msg" python-onkeydown(key)="keydown(ctx)"/>')
+        while 1:
+            session = httpgui.new_session(":8080", env=globals())
+            session.new_page(chat_room)
+    """
+    def __init__(self, html):
+        self._html = html
+        self._token2python = {}
+        self._token2code = {} # {token: compiled python code}
+        self._python2token = {}
+        self._tokenized_html = _tokenize_html(html, self._token)
+        # key of the html in page caches of browsers
+        self._digest = hashlib.sha1(bytes(self._tokenized_html, "utf-8")).hexdigest()[:16]
+
+    def _token(self, python_code):
+        token = self._python2token.get(python_code, None)
+        if token is None:
+            code = _compile_event_handler(python_code)
+            token = b"T(%d)" % (len(self._python2token),)
+            self._token2python[token] = python_code
+            self._token2code[token] = code
+            self._python2token[python_code] = token
+        return token
+
+    def html(self):
+        return self._html
+
+    def tokenized_html(self):
+        return self._tokenized_html
+
+_page_templates = {} # {html: PageTemplate}, recently used pages
+_page_templates_max = 256
+
+def _page_template(html):
+    """returns shared template for html"""
+    template = _page_templates.get(html, None)
+    if template is None:
+        template = PageTemplate(html)
+        if len(_page_templates) >= _page_templates_max:
+            try:
+                del _page_templates[next(iter(_page_templates))]
+            except (KeyError, StopIteration, RuntimeError):
+                pass # another thread changed templates
+        _page_templates[html] = template
+    return template
+
 class Page(object):
     counter = -1 # the first instance will be "dummy", not worth of a natural number
     def __init__(self, session, html, **kw):
         """takes html and session object (parent) as arguments"""
         self._session = session
-        self._html = html
+        if isinstance(html, PageTemplate):
+            self._template = html
+        else:
+            self._template = _page_template(html)
+        # tokens added after the template: update(), current(), ...
         self._token2python = {}
+        self._token2code = {}
         self._python2token = {}
-        self._tokenized_html = self._tokenize_html(html)
         self._elements_received = 0
         self.name = str(Page.counter)
         self._env = {}
         self._timer_interval_ms = kw.get("timer_interval_ms", None)
         self._pending_server_event = kw.get("pending_server_event", None)
         self._static = kw.get("static", None)
+        if kw.get("shadow", session._shadow):
+            self._shadow = {} # {(element_id, attr): last value sent}
+        else:
+            self._shadow = None
+        self._suppressed_updates = 0
         Page.counter += 1
 
     def _tokenize_html(self, html):
         # adds tokens to local tokens, returns tokenized html
-        tokenized_html = []
-        whats_left = html
-        python_event_match = _re_python_attr.search(whats_left)
-        while python_event_match:
-            tokenized_html.append(whats_left[:python_event_match.start()])
-            python_code = python_event_match.groupdict()['python']
-            js_event = python_event_match.groupdict()['js_event']
-            if not python_event_match.groupdict()['event_attrs'] is None:
-                event_attrs = str([a.strip() for a in python_event_match.groupdict()['event_attrs'].split(",")])
-            else:
-                event_attrs = "undefined"
-            if python_code in self._python2token:
-                token = self._python2token[python_code]
-            else:
-                token = b"T(%d)" % (len(self._python2token),)
-                self._token2python[token] = python_code
-                self._python2token[python_code] = token
-            tokenized_html.append(''' %s="send_event('%s', event, this, %s)"''' % (js_event, token.decode("utf-8"), event_attrs))
-            whats_left = whats_left[python_event_match.end():]
-            python_event_match = _re_python_attr.search(whats_left)
-        tokenized_html.append(whats_left)
-        return "".join(tokenized_html)
+        return _tokenize_html(html, self._token)
+
+    def _token(self, python_code):
+        """returns token of python_code, adds a new token if needed"""
+        token = self._template._python2token.get(python_code, None)
+        if token is None:
+            token = self._python2token.get(python_code, None)
+        if token is None:
+            code = _compile_event_handler(python_code)
+            token = b"T(%d)" % (len(self._template._python2token) + len(self._python2token),)
+            self._token2python[token] = python_code
+            self._token2code[token] = code
+            self._python2token[python_code] = token
+        return token
+
+    def _token_code(self, token):
+        """returns compiled python code of token, or None"""
+        code = self._template._token2code.get(token, None)
+        if code is None:
+            code = self._token2code.get(token, None)
+        return code
+
+    def _token_python(self, token):
+        """returns python code or current() callback of token, or None"""
+        python = self._template._token2python.get(token, None)
+        if python is None:
+            python = self._token2python.get(token, None)
+        return python
 
     def html(self):
-        return self._html
+        return self._template._html
 
     def tokenized_html(self):
-        return self._tokenized_html
+        return self._template._tokenized_html
+
+    def template(self):
+        return self._template
 
     def update_env(self, env_dict):
         """add variables (keys) and values (values) in dict to run env"""
@@ -798,26 +3256,17 @@ class Page(object):
                     key = key_nofilter
                     _in_paren = _after_open_paren.split(")", 1)[0]
                     event_attrs = [a.strip() for a in _in_paren.split(",")]
-                    event_attr_list = str(event_attrs)
+                    event_attr_list = event_attrs
                 else:
-                    event_attr_list = "undefined"
+                    event_attr_list = None
                 try:
                     js_event = _re_python_event.match(key).groupdict()['js_event'][2:] # skip "on" prefix
                 except Exception as e:
                     raise ValueError('invalid python-on* event: %r' % (key,))
                 python_code = env_dict[key]
-                self._tokenize_html('<dontcare %s="%s" />' % (key, python_code))
-                token = self._python2token[python_code]
-                self._session._add_to_browser_queue(
-                    "if (typeof(httpgui_events) == \"undefined\") httpgui_events=Object();"
-                    "if (typeof(httpgui_events.%(js_event)s) == \"undefined\")"
-                    "    httpgui_events.%(js_event)s = function (event) {"
-                    "        send_event(%(token)r, event, undefined, %(event_attr_list)s); };"
-                    "window.removeEventListener(%(js_event)r, httpgui_events.%(js_event)s);"
-                    "window.addEventListener(%(js_event)r, httpgui_events.%(js_event)s);" %
-                    {"js_event": js_event,
-                     "token": token.decode("utf-8"),
-                     "event_attr_list": event_attr_list})
+                token = self._token(python_code)
+                self._session._add_to_browser_queue(("js", None, _browser_op(
+                    "listen", js_event, token.decode("utf-8"), event_attr_list)))
 
     def session(self):
         return self._session
@@ -848,19 +3297,9 @@ class Page(object):
                        lambda d: pprint.pprint(d))
         """
         token = b"C(%r)" % (",".join(names),)
-        to_queue = ['send_to_server(%(token)r, JSON.stringify({"current_dict":{' % {"token": token.decode("UTF-8")}]
-        for name in names:
-            if "." in name:
-                eid, attr = name.split(".", 1)
-            else:
-                eid, attr = name, "innerHTML"
-            to_queue.append('%(name)r: document.getElementById(%(eid)r).%(attr)s,' % {
-                'name': name,
-                'eid': eid,
-                'attr': attr})
-        to_queue.append('}}), eval_response)')
         self._token2python[token] = cb
-        self._session._add_to_browser_queue(''.join(to_queue))
+        self._session._add_to_browser_queue(
+            ("js", None, _browser_op("current", token.decode("UTF-8"), list(names))))
 
     def update(self, name_content_dict):
         """Change page contents: inner HTMLs or attributes
@@ -881,42 +3320,319 @@ class Page(object):
         if not isinstance(name_content_dict, dict):
             raise TypeError('Page.update() requires dict as a parameter, got %s'
                             % (type(name_content_dict),))
-        to_queue = []
-        for name in name_content_dict:
-            if name == "js":
-                # run raw javascript
-                to_queue.append(name_content_dict[name])
-            elif name.startswith("window."):
-                # direct access to some javascript objects
-                # example: {"window.location.href": "http://new/url"}
-                to_queue.append("%(eid)s=%(new_value)r;" % (name, name_content_dict[name]))
-            elif "." in name:
-                # replace an attribute
-                # example: {"myEltID.myEltAttr": "new value"}
-                eid, attr = name.split(".", 1)
-                if not "-" in attr and not " " in attr:
-                    to_queue.append("document.getElementById(%(eid)r).%(attr)s=%(new_value)r;" % {
-                        'eid': eid,
-                        'attr': attr,
-                        'new_value': name_content_dict[name]})
+        if not self._shadow is None:
+            name_content_dict = self._shadow_changes(name_content_dict)
+        self._session._add_to_browser_queue(
+            *[entry for name, entry in _update_entries(name_content_dict, self._tokenize_html)])
+
+    def append(self, eid, html):
+        """Add html after the last child of element eid
+
+        Unlike update({eid: ...}), append(), prepend(), remove(),
+        replace() and move() change only the given elements, so
+        adding an item to a long list or log does not send the list
+        again. python-on* attributes in html work as in update().
+        On a page with shadow state (see Session.new_page) they make
+        the page forget values sent by update() so far.
+
+        Example:
+          page.append("log", '<p id="line-%d">%s</p>' % (n, line))
+        """
+        self._dom_op("insert", eid, "beforeend", self._tokenize_html(html))
+
+    def prepend(self, eid, html):
+        """Add html before the first child of element eid"""
+        self._dom_op("insert", eid, "afterbegin", self._tokenize_html(html))
+
+    def remove(self, eid):
+        """Remove element eid"""
+        self._dom_op("remove", eid)
+
+    def replace(self, eid, html):
+        """Replace element eid, including its own tag, with html"""
+        self._dom_op("replace", eid, self._tokenize_html(html))
+
+    def move(self, eid, target_eid, position="beforeend"):
+        """Move element eid next to or inside element target_eid
+
+        Parameters:
+          position (string):
+                  "beforebegin", "afterbegin", "beforeend" (default)
+                  or "afterend" of target_eid, as in
+                  Element.insertAdjacentElement()
+        """
+        if not position in _dom_positions:
+            raise ValueError('invalid position %r, expected one of %s' % (position, ", ".join(_dom_positions)))
+        self._dom_op("move", eid, target_eid, position)
+
+    def _dom_op(self, *op):
+        if not self._shadow is None:
+            # elements with remembered values may have been added,
+            # removed or changed
+            self.invalidate_shadow()
+        self._session._add_to_browser_queue(("dom", None, _browser_op(*op)))
+
+    def _activation_ops(self, html=True):
+        """returns operations that show the page on the browser,
+        html=False applies the page settings to html that a new base
+        page already shows. Called with the browser queue lock of the
+        session acquired."""
+        ops = []
+        settings = {}
+        if not self._pending_server_event is None:
+            settings["pending_server_event"] = self._pending_server_event
+        if not self._timer_interval_ms is None:
+            # a positive interval starts the timer
+            settings["timer_interval_ms"] = self._timer_interval_ms
+        if self._static:
+            settings.update({
+                "pending_server_event": 0,
+                "timer_interval_ms": 0,
+                "session_id": ""})
+        if settings:
+            ops.append(_browser_op("settings", settings))
+        if html:
+            ops.append(self._session._show_page_ops(self))
+        else:
+            ops.append(self._session._cache_shown_page_ops(self))
+        return ",".join([op for op in ops if op])
+
+    def _rerender_entries(self, queue):
+        """returns browser queue entries that replace queue and show
+        the page as it should be. The last page switch in queue is
+        kept, updates remembered in the shadow are sent again."""
+        # html of dropped page switches may be missing from the
+        # browser's page cache
+        self._session._forget_browser_pages()
+        if [entry for entry in queue if entry[0] == "page"]:
+            # the last page switch activated this page
+            entries = [("page", None, self._activation_ops())]
+        else:
+            entries = [("page", None, self._session._show_page_ops(self))]
+        if self._shadow:
+            names = {}
+            for key, value in self._shadow.items():
+                if key[0] is None:
+                    names[key[1]] = value
+                elif key[1] == "innerHTML":
+                    names[key[0]] = value
                 else:
-                    to_queue.append("document.getElementById(%(eid)r).setAttribute(%(attr)r, %(new_value)r);" % {
-                        'eid': eid,
-                        'attr': attr,
-                        'new_value': name_content_dict[name]})
-            else:
-                # replace contents of element
-                # example: {"myDivID": "new html"}
-                content = self._tokenize_html(name_content_dict[name])
-                to_queue.append("document.getElementById(%(name)r).innerHTML=%(content)r;" % {
-                    'name': name,
-                    'content': content})
-        self._session._add_to_browser_queue("".join(to_queue))
+                    names["%s.%s" % key] = value
+            entries.extend([entry for name, entry in _update_entries(names, self._tokenize_html)])
+        return entries
+
+    def _shadow_changes(self, name_content_dict):
+        """returns names and values that the browser does not have yet
+        and remembers them as sent"""
+        shadow = self._shadow
+        changes = {}
+        for name, value in name_content_dict.items():
+            if name != "js":
+                # skip sending values that the browser already has
+                key = _update_key(name)
+                if key in shadow and shadow[key] == value:
+                    self._suppressed_updates += 1
+                    continue
+                shadow[key] = value
+            changes[name] = value
+        return changes
+
+    def invalidate_shadow(self, names=None):
+        """Forget values sent with update(), send them again next time.
+
+        Parameters:
+          names (list of strings, optional):
+                  names as in update() whose values the browser may
+                  have changed, for instance ["my-input.value"].
+                  By default forget all values.
+        """
+        if self._shadow is None:
+            return
+        if names is None:
+            self._shadow.clear()
+            return
+        for name in names:
+            self._shadow.pop(_update_key(name), None)
+
+    def suppressed_updates(self):
+        """Returns the number of unchanged values that update() has
+        not sent to the browser thanks to the shadow option."""
+        return self._suppressed_updates
 
     def browser_reload(self):
         """Reload-button pressed"""
         pass
 
+class Group(object):
+    """
+    Group of sessions whose active pages get the same updates.
+    Updates are formatted once for all sessions in the group.
+    """
+    def __init__(self, protocol, name):
+        self.name = name
+        self._protocol = protocol
+        self._sessions = {} # {session: None}, insertion ordered set
+        self._lock = _thread.allocate_lock()
+
+    def add(self, session):
+        """Add session to the group"""
+        self._lock.acquire()
+        try:
+            self._sessions[session] = None
+            session._groups.add(self)
+        finally: self._lock.release()
+
+    def remove(self, session):
+        """Remove session from the group"""
+        self._lock.acquire()
+        try:
+            self._sessions.pop(session, None)
+            session._groups.discard(self)
+        finally: self._lock.release()
+
+    def sessions(self):
+        """Returns list of sessions in the group"""
+        self._lock.acquire()
+        try:
+            return list(self._sessions)
+        finally: self._lock.release()
+
+    def update(self, name_content_dict):
+        """Change contents of active pages of all sessions in the group.
+
+        Parameters:
+          name_content_dict (dict):
+                  as in Page.update()
+        """
+        if not isinstance(name_content_dict, dict):
+            raise TypeError('Group.update() requires dict as a parameter, got %s'
+                            % (type(name_content_dict),))
+        self._update(name_content_dict)
+        if not self._protocol._bus is None:
+            # sessions in other worker processes
+            self._protocol._bus.send_all({"group": self.name, "update": name_content_dict})
+
+    def _update(self, name_content_dict):
+        # consecutive names that are formatted once for all pages or
+        # by each page, [(per_page, {name: value}, shared entries)]
+        runs = []
+        for name, value in name_content_dict.items():
+            # python-on* attributes are tokenized by each page
+            per_page = (name != "js" and not "." in name and isinstance(value, str)
+                        and not _re_python_attr.search(value) is None)
+            if not runs or runs[-1][0] != per_page:
+                runs.append((per_page, {}))
+            runs[-1][1][name] = value
+        runs = [(per_page, names, None if per_page else _update_entries(names))
+                for per_page, names in runs]
+        for session in self.sessions():
+            page = session.page()
+            updates = []
+            for per_page, names, entries in runs:
+                if not page._shadow is None:
+                    names = page._shadow_changes(names)
+                    if not per_page:
+                        entries = [(name, entry) for name, entry in entries if name in names]
+                if per_page:
+                    entries = _update_entries(names, page._tokenize_html)
+                updates.extend([entry for name, entry in entries])
+            session._add_to_browser_queue(*updates)
+
+_worker_bus_max_datagram = 65536 # larger messages are passed in a file
+
+class _WorkerBus(object):
+    """
+    Unix datagram sockets between worker processes of a Protocol, see
+    Protocol.fork_workers(). Messages are a line of JSON and
+    optional payload bytes. They hand over connections to the worker
+    that owns their session, and carry group updates and published
+    data to all workers.
+    """
+    def __init__(self, protocol, directory, worker, count, sock, first_pid):
+        self._protocol = protocol
+        self._directory = directory
+        self._worker = worker
+        self._count = count
+        self._sock = sock
+        self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._first_pid = first_pid # None in worker 0
+        if not first_pid is None:
+            # check every second that worker 0 is alive
+            self._sock.settimeout(1.0)
+        _thread.start_new_thread(self._receive, ())
+
+    def hand_over(self, worker, conn, host_port, received):
+        """send connection and bytes received from it to worker"""
+        try:
+            self.send(worker, {"connection": list(host_port)}, received, [conn.fileno()])
+        except Exception as e:
+            log("handing over connection to worker %d failed: %s" % (worker, e))
+
+    def send_all(self, message):
+        """send message to all other workers"""
+        for worker in range(self._count):
+            if worker != self._worker:
+                try:
+                    self.send(worker, message)
+                except OSError as e:
+                    log("sending to worker %d failed: %s" % (worker, e))
+
+    def send(self, worker, message, payload=b"", fds=()):
+        data = bytes(json.dumps(message), "utf-8") + b"\n" + payload
+        fds = list(fds)
+        spill = None
+        if len(data) > _worker_bus_max_datagram:
+            # an empty datagram tells that the message is in the last fd
+            spill = tempfile.TemporaryFile()
+            spill.write(data)
+            spill.flush()
+            fds.append(spill.fileno())
+            data = b""
+        try:
+            ancdata = []
+            if fds:
+                ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack("%di" % (len(fds),), *fds)))
+            self._send_sock.sendmsg([data], ancdata, 0,
+                                   os.path.join(self._directory, "worker-%d" % (worker,)))
+        finally:
+            if spill:
+                spill.close()
+
+    def _receive(self):
+        while 1:
+            try:
+                data, fds, flags, address = socket.recv_fds(self._sock, _worker_bus_max_datagram, 4)
+            except socket.timeout:
+                if os.getppid() != self._first_pid:
+                    log("worker %d: worker 0 has exited, exiting" % (self._worker,))
+                    os._exit(0)
+                continue
+            except OSError as e:
+                log("worker %d: receiving from other workers failed: %s" % (self._worker, e))
+                continue
+            try:
+                if not data and fds:
+                    spill = os.fdopen(fds.pop(), "rb")
+                    try:
+                        spill.seek(0)
+                        data = spill.read()
+                    finally: spill.close()
+                head, _, payload = data.partition(b"\n")
+                message = json.loads(head)
+                if "connection" in message:
+                    sock = socket.socket(fileno=fds.pop(0))
+                    self._protocol._adopt_connection(sock, tuple(message["connection"]), payload)
+                elif "group" in message:
+                    group = self._protocol._groups.get(message["group"], None)
+                    if not group is None:
+                        group._update(message["update"])
+                elif "publish" in message:
+                    self._protocol._deliver(message["publish"], message["data"])
+            except Exception as e:
+                log("worker %d: invalid message from other workers: %s" % (self._worker, e))
+            for fd in fds:
+                os.close(fd)
+
 class Context(object):
     def __init__(self, session, page):
         self.session = session
@@ -924,6 +3640,16 @@ class Context(object):
 
 _protocol = Protocol()
 new_session = _protocol.new_session
+group = _protocol.group
+remove_group = _protocol.remove_group
+callback_stats = _protocol.callback_stats
+metrics = _protocol.metrics
+handler_stats = _protocol.handler_stats
+fork_workers = _protocol.fork_workers
+on_session = _protocol.on_session
+serve = _protocol.serve
+publish = _protocol.publish
+subscribe = _protocol.subscribe
 
 if __name__ == "__main__":
     print("httpgui self-test and example")
@@ -0,0 +1,498 @@
+"""httpgui_bench - load generator for httpgui servers
+
+Usage: python3 -m httpgui_bench [--scenario chat|counters] [--clients N]
+                                [--group-size N] [--rate EVENTS_PER_S]
+                                [--duration S] [--engine threads|selectors]
+                                [--port PORT] [--connect HOST:PORT] [--json]
+       python3 -m httpgui_bench --serve chat|counters HOST:PORT
+                                [--engine threads|selectors]
+
+Acts like N browsers: each one loads the base page, reads its
+session_id, keeps a wait_server_event long-poll pending and sends
+T(n) events with send_event() style JSON bodies. Events are sent at
+the given total rate.
+
+Scenarios are modelled on examples/chat and examples/counters:
+  chat      users in rooms of --group-size users send messages. Every
+            message is appended to the message list of every user in the
+            room.
+  counters  users watch counters shared by --group-size users. Every
+            click updates the counter on every watcher's page.
+
+By default the scenario server is started in a subprocess on --port
+and its RSS is reported. With --connect clients use a scenario server
+started elsewhere with --serve.
+
+Reports sessions, event throughput, event round-trip latency, push
+latency (from sending an event until another browser receives the
+update) and server RSS. --json prints the results as one JSON line
+for comparing releases.
+"""
+
+import html
+import itertools
+import json
+import os
+import random
+import re
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+import httpgui
+
+_re_session_id = re.compile(rb'"session_id": "([^"]*)"')
+_re_token = re.compile(rb"send_event\(\\*'(T\([0-9]+\))")
+_re_stamp = re.compile(rb"@@([0-9]+\.[0-9]+)@@")
+
+### Scenario servers
+
+_chat_max_messages = 16
+
+_chat_html = """
+<table>
+<tr><td>Room:</td><td id="room">%(room)s</td></tr>
+<tr><td>Users:</td><td id="users"></td></tr>
+</table>
+<div id="messages"></div>
+%(user)s: <input id="message" type="text" python-onkeydown(key,target)="chat_keydown(ctx)"/>
+"""
+
+_counter_html_row = """
+<tr><td><input type="button" value="&plus;" python-onclick(timeStamp)="counter_add(ctx, %(row)d, 1)"/></td>
+<td id="v%(row)d" align="right">%(value)d</td>
+<td><input type="button" value="&minus;" python-onclick(timeStamp)="counter_add(ctx, %(row)d, -1)"/></td>
+<td id="stamp%(row)d"></td></tr>
+"""
+
+def _chat_message_html(msg_id, message):
+    return '<div id="msg-%d" class="t new">%s</div>' % (msg_id, message)
+
+def _serve_chat(protocol, host_port):
+    rooms = {} # {room: [session, ...]}
+    message_ids = itertools.count()
+    def chat_keydown(ctx):
+        if ctx.event.get("key") != "Enter":
+            return
+        sender = ctx.session
+        message = sender.user + ": " + html.escape(ctx.event["target"]["value"])
+        msg_id = next(message_ids)
+        for session in rooms[sender.room]:
+            page = session.page()
+            session.messages.append(msg_id)
+            page.append("messages", _chat_message_html(msg_id, message))
+            if len(session.messages) > _chat_max_messages:
+                page.remove("msg-%d" % (session.messages.pop(0),))
+        sender.page().update({"message.value": ""})
+    while 1:
+        session = protocol.new_session(host_port)
+        try:
+            _, session.room, session.user = session.path().split("/")
+        except ValueError:
+            session.new_page("Bad URL, expected /ROOM/USER", static=True)
+            continue
+        session.messages = []
+        rooms.setdefault(session.room, []).append(session)
+        protocol.group(session.room).add(session)
+        session.new_page(_chat_html % {"room": session.room, "user": session.user},
+                         {"chat_keydown": chat_keydown})
+        protocol.group(session.room).update(
+            {"users": ", ".join([s.user for s in rooms[session.room]])})
+
+def _serve_counters(protocol, host_port):
+    counters = {} # {name: [value, ...]}
+    def counter_add(ctx, row, amount):
+        name = ctx.session.counter
+        counters[name][row] += amount
+        protocol.group(name).update({"v%d" % (row,): str(counters[name][row]),
+                                     "stamp%d" % (row,): "@@%s@@" % (ctx.event.get("timeStamp", 0),)})
+    while 1:
+        session = protocol.new_session(host_port)
+        try:
+            _, command, session.counter = session.path().split("/")
+            if command != "count":
+                raise ValueError(command)
+        except ValueError:
+            session.new_page("Bad URL, expected /count/COUNTER", static=True)
+            continue
+        values = counters.setdefault(session.counter, [0, 0, 0])
+        protocol.group(session.counter).add(session)
+        session.new_page('<table class="t">%s</table>' % (
+            "".join([_counter_html_row % {"row": row, "value": value}
+                     for row, value in enumerate(values)]),),
+                         {"counter_add": counter_add})
+
+_scenarios = {
+    # name: (server, browser path of client number i, event body)
+    "chat": (_serve_chat,
+             lambda i, group_size: "/room%d/user%d" % (i // group_size, i),
+             lambda stamp: {"event": {"key": "Enter",
+                                      "target": {"id": "message", "type": "text",
+                                                 "value": "hello @@%.6f@@" % (stamp,)}}}),
+    "counters": (_serve_counters,
+                 lambda i, group_size: "/count/counter%d" % (i // group_size,),
+                 lambda stamp: {"event": {"timeStamp": "%.6f" % (stamp,)}}),
+}
+
+def serve(scenario, host_port, engine="threads"):
+    """run scenario server, never returns"""
+    httpgui.log = lambda msg: None
+    protocol = httpgui.Protocol(engine=engine)
+    _scenarios[scenario][0](protocol, host_port)
+
+### Browsers
+
+class _Connection(object):
+    """
+    Keep-alive HTTP connection. Responses are passed to callbacks of
+    requests in the order the requests were sent.
+    """
+    def __init__(self, bench, host_port):
+        self.sock = socket.create_connection(host_port)
+        self.sock.setblocking(False)
+        self._bench = bench
+        self._buf = b""
+        self._callbacks = [] # [(callback, sent_time), ...]
+        self._outbuf = b""
+        bench._selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def request(self, method, path, body, callback):
+        self._outbuf += (b"%s %s HTTP/1.1\r\nHost: bench\r\n"
+                         b"Content-Length: %d\r\n\r\n%s") % (method, path, len(body), body)
+        self._callbacks.append((callback, time.time()))
+        self._write()
+
+    def _write(self):
+        try:
+            sent = self.sock.send(self._outbuf)
+            self._outbuf = self._outbuf[sent:]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close()
+            return
+        events = selectors.EVENT_READ
+        if self._outbuf:
+            events |= selectors.EVENT_WRITE
+        self._bench._selector.modify(self.sock, events, self)
+
+    def ready(self, mask):
+        if mask & selectors.EVENT_WRITE:
+            self._write()
+        if not mask & selectors.EVENT_READ:
+            return
+        try:
+            data = self.sock.recv(262144)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+            return
+        self._bench.bytes_received += len(data)
+        self._buf += data
+        while self._callbacks:
+            head_end = self._buf.find(b"\r\n\r\n")
+            if head_end == -1:
+                return
+            head = self._buf[:head_end]
+            match = re.search(rb"Content-Length: ([0-9]+)", head, re.I)
+            length = int(match.group(1)) if match else 0
+            if len(self._buf) < head_end + 4 + length:
+                return
+            status = head.split(b" ", 2)[1]
+            body = self._buf[head_end + 4:head_end + 4 + length]
+            self._buf = self._buf[head_end + 4 + length:]
+            callback, sent_time = self._callbacks.pop(0)
+            callback(status, body, sent_time)
+
+    def close(self):
+        try:
+            self._bench._selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback, sent_time in callbacks:
+            callback(None, b"", sent_time)
+
+class _Browser(object):
+    """
+    Simulated browser: loads the base page on one connection, sends
+    events on it and waits for server events on another connection.
+    """
+    def __init__(self, bench, path):
+        self._bench = bench
+        self._path = bytes(path, "utf-8")
+        self.session_id = None
+        self.token = None
+        self.event_pending = False
+        self._events_conn = None
+        self._poll_conn = None
+        self._poll_count = 0
+        self._stamps_seen = set()
+
+    def start(self):
+        self._events_conn = _Connection(self._bench, self._bench.host_port)
+        self._events_conn.request(b"GET", self._path, b"", self._base_page_received)
+
+    def _base_page_received(self, status, body, sent_time):
+        match = _re_session_id.search(body)
+        if status != b"200" or not match:
+            # the server was not ready for a new session, try again
+            self._events_conn.close()
+            self._bench.retry(self)
+            return
+        self.session_id = match.group(1)
+        self._poll_conn = _Connection(self._bench, self._bench.host_port)
+        self._poll()
+        self._find_token(body) # the first page may be in the base page
+
+    def _poll(self):
+        self._poll_conn.request(b"GET", b"/%s/wait_server_event(%d)" % (self.session_id, self._poll_count),
+                                b"", self._server_event_received)
+        self._poll_count += 1
+
+    def _server_event_received(self, status, body, sent_time):
+        if status != b"200":
+            self._bench.errors += 1
+            return
+        self._find_token(body)
+        self._bench.pushes += 1
+        self._record_stamps(body)
+        self._poll()
+
+    def _find_token(self, body):
+        if self.token is None:
+            match = _re_token.search(body)
+            if match:
+                self.token = match.group(1)
+                self._bench.browser_ready(self)
+
+    def send_event(self, body):
+        self.event_pending = True
+        self._events_conn.request(b"POST", b"/%s/%s" % (self.session_id, self.token),
+                                  bytes(json.dumps(body), "utf-8"), self._event_response_received)
+
+    def _event_response_received(self, status, body, sent_time):
+        self.event_pending = False
+        if status != b"200":
+            self._bench.errors += 1
+            return
+        self._bench.event_latencies.append(time.time() - sent_time)
+        self._record_stamps(body)
+
+    def _record_stamps(self, body):
+        now = time.time()
+        for match in _re_stamp.finditer(body):
+            stamp = match.group(1)
+            if not stamp in self._stamps_seen:
+                self._stamps_seen.add(stamp)
+                self._bench.push_latencies.append(now - float(stamp))
+        if len(self._stamps_seen) > 1000:
+            self._stamps_seen = set([s for s in self._stamps_seen if now - float(s) < 60])
+
+class _Bench(object):
+    def __init__(self, host_port, scenario, clients, group_size):
+        self.host_port = host_port
+        self.bytes_received = 0
+        self.errors = 0
+        self.pushes = 0
+        self.event_latencies = []
+        self.push_latencies = []
+        self._selector = selectors.DefaultSelector()
+        self._event_body = _scenarios[scenario][2]
+        path = _scenarios[scenario][1]
+        self._waiting = [_Browser(self, path(i, group_size)) for i in range(clients)]
+        self._starting = []
+        self._ready = []
+
+    def retry(self, browser):
+        self._starting.remove(browser)
+        self._waiting.append(browser)
+
+    def browser_ready(self, browser):
+        self._starting.remove(browser)
+        self._ready.append(browser)
+
+    def _poll(self, timeout):
+        for key, mask in self._selector.select(timeout):
+            key.data.ready(mask)
+
+    def establish(self, timeout=600):
+        """start browsers a few at a time, returns when all have
+        received their first page"""
+        end = time.time() + timeout
+        while (self._waiting or self._starting) and time.time() < end:
+            while self._waiting and len(self._starting) < 16:
+                browser = self._waiting.pop(0)
+                self._starting.append(browser)
+                browser.start()
+            self._poll(0.01)
+        return len(self._ready)
+
+    def run(self, rate, duration):
+        """send rate events per second for duration seconds"""
+        self.bytes_received = 0
+        self.pushes = 0
+        start = time.time()
+        sent = 0
+        while 1:
+            now = time.time()
+            if now - start >= duration:
+                break
+            due = int((now - start) * rate) - sent
+            for i in range(due):
+                browser = random.choice(self._ready)
+                if browser.event_pending:
+                    continue # like a user who waits for the response
+                browser.send_event(self._event_body(time.time()))
+                sent += 1
+            self._poll(0.001)
+        elapsed = time.time() - start
+        # let responses to the last events arrive
+        end = time.time() + 1.0
+        while time.time() < end:
+            self._poll(0.01)
+        return sent, elapsed
+
+### Results
+
+def _percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def _server_rss_kb(pid):
+    rss, peak = -1, -1
+    try:
+        for line in open("/proc/%d/status" % (pid,)):
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+            elif line.startswith("VmHWM:"):
+                peak = int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return rss, peak
+
+def _wait_for_server(host_port, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(host_port).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def main():
+    scenario, clients, group_size, rate, duration = "chat", 100, 10, 100.0, 10.0
+    engine, port, connect, print_json = "selectors", 54322, None, False
+    args = sys.argv[1:]
+    if args[:1] == ["--serve"]:
+        try:
+            scenario, hostspec = args[1], args[2]
+            host, port_s = hostspec.split(":")
+            if args[3:5] == ["--engine"]:
+                engine = args[4]
+        except (IndexError, ValueError):
+            sys.exit(__doc__)
+        serve(scenario, "%s:%s" % (host, port_s), engine)
+    while args:
+        opt = args.pop(0)
+        if opt == "--json":
+            print_json = True
+            continue
+        if not args:
+            sys.exit(__doc__)
+        value = args.pop(0)
+        if opt == "--scenario" and value in _scenarios:
+            scenario = value
+        elif opt == "--clients":
+            clients = int(value)
+        elif opt == "--group-size":
+            group_size = int(value)
+        elif opt == "--rate":
+            rate = float(value)
+        elif opt == "--duration":
+            duration = float(value)
+        elif opt == "--engine":
+            engine = value
+        elif opt == "--port":
+            port = int(value)
+        elif opt == "--connect":
+            host, port_s = value.split(":")
+            connect = (host, int(port_s))
+        else:
+            sys.exit(__doc__)
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 2 * clients + 100:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, 2 * clients + 100), hard))
+    except (ImportError, ValueError):
+        pass
+
+    server = None
+    host_port = connect
+    if connect is None:
+        host_port = ("localhost", port)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "httpgui_bench", "--serve", scenario,
+             "localhost:%d" % (port,), "--engine", engine],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        if not _wait_for_server(host_port):
+            sys.exit("httpgui_bench: cannot connect to %s:%d" % host_port)
+        bench = _Bench(host_port, scenario, clients, group_size)
+        t0 = time.time()
+        established = bench.establish()
+        setup_time = time.time() - t0
+        sent, elapsed = bench.run(rate, duration)
+        rss, peak = _server_rss_kb(server.pid) if server else (-1, -1)
+    finally:
+        if server:
+            server.kill()
+            server.wait()
+    results = {
+        "scenario": scenario,
+        "engine": engine if server else None,
+        "clients": clients,
+        "group_size": group_size,
+        "sessions": established,
+        "setup_seconds": setup_time,
+        "events": sent,
+        "events_per_second": sent / elapsed,
+        "errors": bench.errors,
+        "pushes_per_second": bench.pushes / elapsed,
+        "received_bytes_per_second": bench.bytes_received / elapsed,
+        "event_latency_p50_ms": _percentile(bench.event_latencies, 0.5) * 1000,
+        "event_latency_p99_ms": _percentile(bench.event_latencies, 0.99) * 1000,
+        "push_latency_p50_ms": _percentile(bench.push_latencies, 0.5) * 1000,
+        "push_latency_p99_ms": _percentile(bench.push_latencies, 0.99) * 1000,
+        "server_rss_kb": rss,
+        "server_peak_rss_kb": peak,
+    }
+    if print_json:
+        print(json.dumps(results))
+        return
+    print("scenario:          %s, %d clients in groups of %d%s" % (
+        scenario, clients, group_size, ", engine " + engine if server else ""))
+    print("sessions:          %d (established in %.1f s)" % (established, setup_time))
+    print("events:            %d in %.1f s (%.1f/s), %d errors" % (
+        sent, elapsed, results["events_per_second"], bench.errors))
+    print("event latency:     p50 %.2f ms, p99 %.2f ms" % (
+        results["event_latency_p50_ms"], results["event_latency_p99_ms"]))
+    print("pushes:            %.1f/s, %.1f kB/s" % (
+        results["pushes_per_second"], results["received_bytes_per_second"] / 1024))
+    print("push latency:      p50 %.2f ms, p99 %.2f ms" % (
+        results["push_latency_p50_ms"], results["push_latency_p99_ms"]))
+    if rss >= 0:
+        print("server RSS:        %.1f MB (peak %.1f MB)" % (rss / 1024, peak / 1024))
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ setup(name         = 'httpgui',
       description  = 'Hot Penguin - Python GUI over HTTP without Javascript',
       author       = 'Antti Kervinen',
       author_email = 'antti.kervinen@gmail.com',
-      py_modules   = ['httpgui'],
+      py_modules   = ['httpgui', 'httpgui_bench'],
       classifiers  = [
           'Development Status :: 3 - Alpha',
           'Intended Audience :: Developers',
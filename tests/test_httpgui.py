@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Tests that run httpgui servers on ephemeral ports with both engines.
+
+Run: python3 -m pytest tests  or  python3 -m unittest discover tests
+"""
+
+import gzip
+import os
+import re
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpgui
+
+def request(sock, method, path, body=b"", headers=b""):
+    """send an HTTP/1.1 request, returns response head and body"""
+    sock.sendall(b"%s %s HTTP/1.1\r\nHost: x\r\n%sContent-Length: %d\r\n\r\n%s" % (
+        method, path, headers, len(body), body))
+    data = b""
+    while not b"\r\n\r\n" in data:
+        received = sock.recv(65536)
+        if not received:
+            raise EOFError("connection closed, received %r" % (data,))
+        data += received
+    head, body = data.split(b"\r\n\r\n", 1)
+    length = int(re.search(rb"Content-Length: (\d+)", head, re.I).group(1))
+    while len(body) < length:
+        body += sock.recv(65536)
+    return head, body[:length]
+
+def session_id(head, body):
+    if b"Content-Encoding: gzip" in head:
+        body = gzip.decompress(body)
+    return re.search(rb'"session_id": "([^"]*)"', body).group(1)
+
+class EngineTests(object):
+    engine = None
+
+    def setUp(self):
+        self.logs = []
+        self._orig_log = httpgui.log
+        httpgui.log = self.logs.append
+
+    def tearDown(self):
+        httpgui.log = self._orig_log
+
+    def serve(self, handler, protocol_kw={}, **kw):
+        """returns protocol and a connection to its ephemeral port
+        where handler(session) is called for new sessions"""
+        p = httpgui.Protocol(engine=self.engine, first_page_wait=0, **protocol_kw)
+        p.on_session("localhost:0", handler, **kw)
+        port = p._sockets[("localhost", 0)].getsockname()[1]
+        return p, self.connect(port)
+
+    def connect(self, port):
+        for retry in range(50):
+            try:
+                conn = socket.create_connection(("localhost", port))
+                conn.settimeout(5)
+                return conn
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        self.fail("cannot connect to port %d" % (port,))
+
+    def wait_until(self, condition):
+        for retry in range(100):
+            if condition():
+                return
+            time.sleep(0.02)
+        self.fail("timeout")
+
+    def test_bad_path_and_failing_request(self):
+        p, conn = self.serve(lambda session: session.new_page("hello"))
+        port = conn.getpeername()[1]
+        for path in (b"/\xff\xfe", b"/.httpgui/\xc3", b"/.session-1/\xff"):
+            c = self.connect(port)
+            head, body = request(c, b"GET", path)
+            self.assertTrue(head.startswith(b"HTTP/1.1 400"), head)
+        if self.engine == "threads":
+            return # a failing request thread does not stop others
+        # an exception in the event loop closes only its connection
+        route_request = p._route_request
+        def failing_route_request(conn, request, *args):
+            if request.path == b"/fail":
+                raise RuntimeError("failing request")
+            return route_request(conn, request, *args)
+        p._route_request = failing_route_request
+        c = self.connect(port)
+        c.sendall(b"GET /fail HTTP/1.1\r\nHost: x\r\n\r\n")
+        try:
+            self.assertEqual(c.recv(100), b"")
+        except ConnectionResetError:
+            pass
+        head, body = request(conn, b"GET", b"/ok")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"), head)
+        self.assertTrue([l for l in self.logs if "failing request" in l], self.logs)
+
+    def test_drop_oldest_keeps_page_switches(self):
+        sessions = []
+        def app(session):
+            session.new_page('<p id="a">page A</p>')
+            sessions.append(session)
+        p, conn = self.serve(app, max_queue_entries=3, queue_policy="drop_oldest")
+        head, body = request(conn, b"GET", b"/x")
+        sid = session_id(head, body)
+        self.wait_until(lambda: sessions)
+        session = sessions[0]
+        head, body = request(conn, b"GET", b"/%s/wait_server_event(0)" % (sid,))
+        self.assertIn(b"page A", body)
+        page_a = session.page()
+        for i in range(5):
+            page_a.update({"a": "x%d" % (i,)})
+        page_b = session.new_page('<p id="b">page B</p>')
+        for i in range(5):
+            page_b.update({"b": "y%d" % (i,), "b.title": str(i)})
+        queue = session._to_browser_queue
+        self.assertLessEqual(len(queue), 3)
+        self.assertTrue([entry for entry in queue if entry[0] == "page"], queue)
+        head, body = request(conn, b"GET", b"/%s/wait_server_event(1)" % (sid,))
+        self.assertIn(b"page B", body)
+        self.assertIn(b"y4", body)
+        # a queue of page switches only is rerendered
+        for i in range(5):
+            session.set_active(str(page_a))
+            session.set_active(str(page_b))
+        self.assertLessEqual(len(session._to_browser_queue), 3)
+        head, body = request(conn, b"GET", b"/%s/wait_server_event(2)" % (sid,))
+        self.assertIn(b"page B", body)
+        self.assertFalse(session._closed)
+
+    def test_events_wait_for_session_handler(self):
+        events = []
+        def clicked(ctx):
+            events.append("event")
+        def app(session):
+            session.new_page('<p id="x" python-onclick="clicked(ctx)">x</p>', {"clicked": clicked})
+            time.sleep(0.3)
+            events.append("handler done")
+        p, conn = self.serve(app)
+        head, body = request(conn, b"GET", b"/x")
+        sid = session_id(head, body)
+        head, body = request(conn, b"GET", b"/%s/wait_server_event(0)" % (sid,))
+        token = re.search(rb"send_event\(\\*'(T\([0-9]+\))", body).group(1)
+        request(conn, b"POST", b"/%s/%s" % (sid, token), b'{"event": {}}')
+        self.wait_until(lambda: len(events) == 2)
+        self.assertEqual(events, ["handler done", "event"])
+
+    def test_vary_accept_encoding(self):
+        for threshold in (200, None):
+            p, conn = self.serve(lambda session: session.new_page("<p>%s</p>" % ("y" * 3000,)),
+                                 protocol_kw={"compression_threshold": threshold})
+            heads = []
+            for accept in (b"Accept-Encoding: gzip\r\n", b""):
+                head, body = request(conn, b"GET", b"/x", headers=accept)
+                heads.append(head)
+                sid = session_id(head, body)
+                head, body = request(conn, b"GET", b"/%s/wait_server_event(0)" % (sid,), headers=accept)
+                heads.append(head)
+            if threshold is None:
+                self.assertFalse([h for h in heads if b"Vary" in h or b"Content-Encoding" in h], heads)
+            else:
+                for head in heads:
+                    self.assertIn(b"Vary: Accept-Encoding", head)
+                self.assertIn(b"Content-Encoding: gzip", heads[0])
+                self.assertNotIn(b"Content-Encoding", heads[2])
+
+class ThreadsEngineTests(EngineTests, unittest.TestCase):
+    engine = "threads"
+
+class SelectorsEngineTests(EngineTests, unittest.TestCase):
+    engine = "selectors"
+
+class CallbackPoolTests(unittest.TestCase):
+    def test_call_keeps_order(self):
+        for workers in (0, 2):
+            pool = httpgui._CallbackPool(workers)
+            order = []
+            pool.submit("k", lambda: (time.sleep(0.1), order.append("job")))
+            time.sleep(0.02)
+            pool.call("k", order.append, "call")
+            pool.submit("k", order.append, "after")
+            time.sleep(0.1)
+            self.assertEqual(order, ["job", "call", "after"])
+
+    def test_call_from_a_job_of_the_same_key(self):
+        for workers in (0, 1):
+            pool = httpgui._CallbackPool(workers)
+            self.assertEqual(pool.call("k", pool.call, "k", lambda: 42), 42)
+            self.assertEqual(pool.stats()["running"], 0)
+
+if __name__ == "__main__":
+    unittest.main()